@@ -0,0 +1,319 @@
+"""Offline benchmark and load test for the bot.
+
+Replays a seeded mix of synthetic Telegram updates (text, documents, commands and
+retried deliveries) through the real FastAPI app and handlers, with Bedrock, the
+Telegram Bot API and DynamoDB replaced by the local fakes in fakes.py. Reports the
+throughput, the webhook latency percentiles by kind of update, the latency
+percentiles of each stage (from the per update metrics of the bot), the latency of
+the fake dependencies, and the DynamoDB calls by operation.
+
+    python bench/bench.py --updates 500 --concurrency 32
+    python bench/bench.py --json > baseline.json
+    python bench/bench.py --baseline baseline.json --tolerance 0.15
+
+With --baseline, the run fails if the throughput drops, the p99 latency grows, or the
+DynamoDB calls per update grow by more than the tolerance.
+
+Capacity units and bytes are estimated from the item sizes, with DynamoDB's rounding
+(half a read unit per 4KB, a write unit per 1KB). Compare the storage encodings with
+--compression-threshold 0 (text stored as is) against the default.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'Function'))
+
+SECRET_TOKEN = 'benchmark-secret'
+
+COMMANDS = ['/start', '/debug', '/thinking', '/clear']
+
+FAQ_PROMPTS = ['What can you do?', 'How do I clear my history?', 'What is Amazon Bedrock?', 'Which model are you?']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--updates', type=int, default=300, help='number of updates to send')
+    parser.add_argument('--chats', type=int, default=20, help='number of distinct chats')
+    parser.add_argument('--concurrency', type=int, default=16, help='webhook calls in flight, or POLL_WORKERS')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mode', choices=['sync', 'async', 'poll'], default='sync',
+                        help='WEBHOOK_MODE, or poll to run the long polling runner (without retried updates)')
+    parser.add_argument('--stream', action='store_true', help='stream replies with ConverseStream')
+    parser.add_argument('--document-share', type=float, default=0.1)
+    parser.add_argument('--command-share', type=float, default=0.1)
+    parser.add_argument('--retry-share', type=float, default=0.05, help='updates delivered again by Telegram')
+    parser.add_argument('--faq-share', type=float, default=0.0, help='text messages repeating a few FAQ prompts')
+    parser.add_argument('--response-cache-ttl', type=int, help='RESPONSE_CACHE_TTL, with the FAQ prompts marked stateless')
+    parser.add_argument('--bedrock-latency', type=float, default=0.3, help='seconds to the first token')
+    parser.add_argument('--token-latency', type=float, default=0.005, help='seconds between streamed chunks')
+    parser.add_argument('--reply-chars', type=int, default=1500, help='length of the model replies')
+    parser.add_argument('--compression-threshold', type=int, help='CONTENT_COMPRESSION_THRESHOLD, 0 to store text as is')
+    parser.add_argument('--bedrock-throttle', type=float, default=0.0, help='share of throttled model calls')
+    parser.add_argument('--telegram-latency', type=float, default=0.03)
+    parser.add_argument('--telegram-errors', type=float, default=0.0, help='share of failed Bot API calls')
+    parser.add_argument('--dynamodb-latency', type=float, default=0.005)
+    parser.add_argument('--dynamodb-throttle', type=float, default=0.0, help='share of throttled table calls')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed regression against the baseline')
+    parser.add_argument('--verbose', action='store_true', help='keep the bot logs')
+    return parser.parse_args(argv)
+
+
+def configure_environment(args):
+    # The bot reads its configuration at import time
+    os.environ.setdefault('CHATHISTORY_TABLE_NAME', 'ChatHistory')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ['TELEGRAM_BOT_TOKEN'] = '123456:BENCHMARK'
+    os.environ['TELEGRAM_API_SECRET_TOKEN'] = SECRET_TOKEN
+    os.environ['WEBHOOK_MODE'] = 'sync' if args.mode == 'poll' else args.mode
+    os.environ['POLL_WORKERS'] = str(args.concurrency)
+    os.environ['POLL_TIMEOUT'] = '1'
+    os.environ['STREAM_RESPONSES'] = 'true' if args.stream else 'false'
+    os.environ.pop('UPDATE_QUEUE_URL', None)
+    if args.response_cache_ttl is not None:
+        os.environ['RESPONSE_CACHE_TTL'] = str(args.response_cache_ttl)
+        os.environ['STATELESS_PROMPT_PATTERN'] = '|'.join(re.escape(prompt) for prompt in FAQ_PROMPTS)
+    if args.compression_threshold is not None:
+        os.environ['CONTENT_COMPRESSION_THRESHOLD'] = str(args.compression_threshold)
+
+
+def generate_traffic(args, telegram):
+    """Return the (kind, update) pairs to send, the same ones for the same seed"""
+    from fakes import document_update, text_update
+
+    rng = random.Random(args.seed)
+    chats = [100 + index if index % 4 else -100 - index for index in range(args.chats)]
+    traffic = []
+    for update_id in range(1, args.updates + 1):
+        chat_id = rng.choice(chats)
+        roll = rng.random()
+        if traffic and roll < args.retry_share:
+            traffic.append(('retry', rng.choice(traffic)[1]))
+        elif roll < args.retry_share + args.document_share:
+            # A few documents are sent again, so the analysis cache gets some hits
+            file_id = f'doc{rng.randrange(max(args.updates // 20, 1))}'
+            content = telegram.files.setdefault(file_id, ('Some line of text\n' * rng.randint(50, 2000)).encode())
+            traffic.append(('document', document_update(update_id, chat_id, file_id, len(content))))
+        elif roll < args.retry_share + args.document_share + args.command_share:
+            traffic.append(('command', text_update(update_id, chat_id, rng.choice(COMMANDS))))
+        elif roll < args.retry_share + args.document_share + args.command_share + args.faq_share:
+            traffic.append(('faq', text_update(update_id, chat_id, rng.choice(FAQ_PROMPTS))))
+        else:
+            words = ' '.join(rng.choice(['tell', 'me', 'about', 'lambda', 'dynamodb', 'bedrock', 'caching']) for _ in range(rng.randint(3, 60)))
+            traffic.append(('text', text_update(update_id, chat_id, words)))
+    return traffic
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return round(ordered[min(int(fraction * len(ordered)), len(ordered) - 1)], 1)
+
+
+def summarize(samples):
+    return {'count': len(samples), 'p50_ms': percentile(samples, 0.5), 'p99_ms': percentile(samples, 0.99)}
+
+
+async def run_webhook(traffic, latencies, statuses, concurrency):
+    """Send the updates to the webhook, returning the init and elapsed times"""
+    import httpx
+
+    import bot
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(client, kind, update):
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post('/bot', json=update, headers={'x-telegram-bot-api-secret-token': SECRET_TOKEN})
+            latencies[kind].append((time.perf_counter() - started) * 1000)
+            statuses[response.status_code] += 1
+
+    init_started = time.perf_counter()
+    async with bot.lifespan(bot.bot):
+        init_ms = (time.perf_counter() - init_started) * 1000
+        started = time.perf_counter()
+        transport = httpx.ASGITransport(app=bot.bot)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+            await asyncio.gather(*(send(client, kind, update) for kind, update in traffic))
+    # Leaving the lifespan waits for the queued updates and the background work
+    return init_ms, time.perf_counter() - started
+
+
+async def run_polling(telegram, traffic, latencies, statuses):
+    """Queue the updates for getUpdates and run the poller until they have been processed,
+    returning the init and elapsed times. Latencies are from the start of the processing."""
+    import poll
+
+    kinds = {update['update_id']: kind for kind, update in traffic}
+    done = asyncio.Event()
+    process = poll.UpdateProcessor.do_process_update
+
+    async def timed_process(processor, update, coroutine):
+        started = time.perf_counter()
+        try:
+            await process(processor, update, coroutine)
+            statuses['processed'] += 1
+        except Exception:
+            statuses['failed'] += 1
+            raise
+        finally:
+            latencies[kinds[update.update_id]].append((time.perf_counter() - started) * 1000)
+            if sum(statuses.values()) == len(traffic):
+                done.set()
+
+    poll.UpdateProcessor.do_process_update = timed_process
+    stop = asyncio.Event()
+    init_started = time.perf_counter()
+    runner = asyncio.create_task(poll.run(stop))
+    while not poll.bot.application or not poll.bot.application.running:
+        await asyncio.sleep(0.01)
+    init_ms = (time.perf_counter() - init_started) * 1000
+    started = time.perf_counter()
+    telegram.push_updates([update for _, update in traffic])
+    await done.wait()
+    stop.set()
+    # Stopping waits for the background work and the buffered writes
+    await runner
+    return init_ms, time.perf_counter() - started
+
+
+async def run(args):
+    from telegram.ext import ApplicationBuilder
+
+    import bot
+    from fakes import FakeBedrock, FakeDynamoDB, FakeTable, FakeTelegramRequest
+
+    rng = random.Random(args.seed)
+    telegram = FakeTelegramRequest(args.telegram_latency, args.telegram_errors, random.Random(rng.random()))
+    table = FakeTable(bot.CHAT_HISTORY_TABLE, args.dynamodb_latency, args.dynamodb_throttle, random.Random(rng.random()))
+    bedrock = FakeBedrock(args.bedrock_latency, args.token_latency, throttle_rate=args.bedrock_throttle,
+                          rng=random.Random(rng.random()), reply_chars=args.reply_chars)
+    bot.bedrock = bedrock
+    bot.dynamodb = FakeDynamoDB(table, rng=random.Random(rng.random()))
+    bot.table = table
+    bot.build_application = lambda concurrent_updates=False: (
+        ApplicationBuilder().token(bot.TelegramBotToken).concurrent_updates(concurrent_updates)
+        .request(telegram).get_updates_request(telegram).build()
+    )
+
+    # The stage timings of each update, collected as its metrics are emitted
+    stages = defaultdict(list)
+    emit = bot.RequestMetrics.emit
+
+    def collect_and_emit(metrics):
+        for name, milliseconds in metrics.timings().items():
+            stages[name].append(milliseconds)
+        emit(metrics)
+
+    bot.RequestMetrics.emit = collect_and_emit
+
+    traffic = generate_traffic(args, telegram)
+    latencies = defaultdict(list)
+    statuses = defaultdict(int)
+    logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with logs:
+        if args.mode == 'poll':
+            # getUpdates doesn't deliver an update again once it has been confirmed
+            traffic = [(kind, update) for kind, update in traffic if kind != 'retry']
+            init_ms, elapsed = await run_polling(telegram, traffic, latencies, statuses)
+        else:
+            init_ms, elapsed = await run_webhook(traffic, latencies, statuses, args.concurrency)
+
+    all_latencies = [sample for samples in latencies.values() for sample in samples]
+    dynamodb_calls = dict(sorted(table.stats.counts.items()))
+    turns = max(len(latencies['text']) + len(latencies['faq']), 1)
+    return {
+        'config': {name: value for name, value in vars(args).items() if name not in ('json', 'baseline', 'tolerance', 'verbose')},
+        'init_ms': round(init_ms, 1),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(traffic) / elapsed, 2),
+        # For the poller, the time to process each update
+        'webhook': summarize(all_latencies),
+        'webhook_by_kind': {kind: summarize(samples) for kind, samples in sorted(latencies.items())},
+        'stages': {name: summarize(samples) for name, samples in sorted(stages.items())},
+        'status_codes': dict(sorted(statuses.items())),
+        'dependencies': {
+            f'{name}.{operation}': summarize(samples)
+            for name, stats in (('bedrock', bedrock.stats), ('telegram', telegram.stats), ('dynamodb', table.stats))
+            for operation, samples in sorted(stats.latencies.items())
+        },
+        'dynamodb_calls': dynamodb_calls,
+        'dynamodb_calls_per_update': round(sum(dynamodb_calls.values()) / len(traffic), 3),
+        'dynamodb_capacity': {name: round(value, 1) for name, value in sorted(table.stats.capacity.items())},
+        'dynamodb_capacity_per_turn': {name: round(value / turns, 1) for name, value in sorted(table.stats.capacity.items())},
+        'bedrock_calls': dict(bedrock.stats.counts),
+        'errors': {
+            name: dict(stats.errors)
+            for name, stats in (('bedrock', bedrock.stats), ('telegram', telegram.stats), ('dynamodb', table.stats))
+            if stats.errors
+        }
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Return the regressions of the report against the baseline"""
+    regressions = []
+    if report['throughput_per_s'] < baseline['throughput_per_s'] * (1 - tolerance):
+        regressions.append(f"throughput {report['throughput_per_s']}/s, baseline {baseline['throughput_per_s']}/s")
+    if report['webhook']['p99_ms'] > baseline['webhook']['p99_ms'] * (1 + tolerance):
+        regressions.append(f"webhook p99 {report['webhook']['p99_ms']} ms, baseline {baseline['webhook']['p99_ms']} ms")
+    if report['dynamodb_calls_per_update'] > baseline['dynamodb_calls_per_update'] * (1 + tolerance):
+        regressions.append(f"DynamoDB calls per update {report['dynamodb_calls_per_update']}, baseline {baseline['dynamodb_calls_per_update']}")
+    return regressions
+
+
+def print_report(report):
+    print(f"{report['config']['updates']} updates over {report['config']['chats']} chats, "
+          f"{report['config']['concurrency']} in flight, "
+          f"{'long polling' if report['config']['mode'] == 'poll' else report['config']['mode'] + ' webhook'}")
+    print(f"Init {report['init_ms']} ms, elapsed {report['elapsed_s']} s, {report['throughput_per_s']} updates/s")
+    print(f"Status codes: {report['status_codes']}")
+    print('\nWebhook latency')
+    for kind, stats in [('all', report['webhook'])] + list(report['webhook_by_kind'].items()):
+        print(f"  {kind:<10} {stats['count']:>6}  p50 {stats['p50_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms")
+    print('\nStage latency')
+    for name, stats in report['stages'].items():
+        print(f"  {name:<14} {stats['count']:>6}  p50 {stats['p50_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms")
+    print('\nDependencies')
+    for name, stats in report['dependencies'].items():
+        print(f"  {name:<28} {stats['count']:>6}  p50 {stats['p50_ms']:>8} ms  p99 {stats['p99_ms']:>8} ms")
+    print(f"\nDynamoDB calls: {report['dynamodb_calls']} ({report['dynamodb_calls_per_update']} per update)")
+    print(f"DynamoDB capacity: {report['dynamodb_capacity']}")
+    print(f"DynamoDB capacity per text turn: {report['dynamodb_capacity_per_turn']}")
+    if report['errors']:
+        print(f"Injected errors: {report['errors']}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_environment(args)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,395 @@
+"""Local stand-ins for Bedrock, the Telegram Bot API and DynamoDB, used by the benchmarks.
+
+Each stand-in has configurable latency and error injection, and counts its calls.
+"""
+import asyncio
+import copy
+import json
+import math
+import random
+import re
+import string
+import threading
+import time
+from collections import defaultdict
+
+from botocore.exceptions import ClientError
+from telegram.request import BaseRequest
+
+
+class CallStats:
+    """Call counts and latencies of a stand-in, by operation"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.latencies = defaultdict(list)
+        # Capacity units and item bytes, for the table
+        self.capacity = defaultdict(float)
+
+    def record(self, operation, seconds, error=False):
+        with self.lock:
+            self.counts[operation] += 1
+            self.latencies[operation].append(seconds * 1000)
+            if error:
+                self.errors[operation] += 1
+
+
+def value_size(value):
+    """Approximate DynamoDB size of an attribute value, in bytes"""
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, (bytes, bytearray)) or hasattr(value, 'value'):
+        # Binary values, bare or wrapped in a boto3 Binary
+        return len(getattr(value, 'value', value))
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, dict):
+        return 3 + sum(len(name.encode('utf-8')) + value_size(item) for name, item in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return 3 + sum(value_size(item) + 1 for item in value)
+    # Numbers take about a byte per two significant digits, plus one
+    return len(str(value).strip('-').replace('.', '')) // 2 + 1
+
+
+def item_size(item):
+    return sum(len(name.encode('utf-8')) + value_size(value) for name, value in item.items())
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': 'Injected by the benchmark'}}, operation)
+
+
+def made_up_words(count, seed=42):
+    rng = random.Random(seed)
+    return tuple(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 11))) for _ in range(count))
+
+
+class FakeBedrock:
+    """Bedrock runtime client answering Converse and ConverseStream with canned replies.
+
+    latency is the time to the first token, token_latency the time between streamed
+    chunks, and throttle_rate the share of calls failing with ThrottlingException.
+    """
+
+    meta = None
+
+    WORDS = ('the', 'model', 'answer', 'lambda', 'table', 'request', 'latency', 'because', 'which',
+             'should', 'reply', 'history', 'message', 'about', 'with', 'this', 'that', 'when')
+    # Made up words behind the common ones, drawn with Zipf frequencies like the words of a
+    # language, so that replies compress about as well as model text does, not far better
+    VOCABULARY = WORDS + made_up_words(5000)
+    WEIGHTS = tuple(1 / rank for rank in range(1, len(VOCABULARY) + 1))
+
+    def __init__(self, latency=0.5, token_latency=0.02, chunks=20, throttle_rate=0.0, rng=None, reply_chars=100):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.chunks = chunks
+        self.throttle_rate = throttle_rate
+        self.rng = rng or random.Random(0)
+        self.reply_chars = reply_chars
+        self.stats = CallStats()
+
+    def _reply(self):
+        words, length = [], 0
+        while length < self.reply_chars:
+            word = self.rng.choices(self.VOCABULARY, self.WEIGHTS)[0]
+            # Sentences of about 15 words
+            if not words or words[-1].endswith('.'):
+                word = word.capitalize()
+            elif self.rng.random() < 1 / 15:
+                word += '.'
+            words.append(word)
+            length += len(word) + 1
+        text = ' '.join(words)
+        size = math.ceil(len(text) / self.chunks)
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def _usage(self, request):
+        input_chars = sum(len(block.get('text', '')) for message in request['messages'] for block in message['content'])
+        output_tokens = self.reply_chars // 4 + 1
+        return {'inputTokens': input_chars // 4 + 1, 'outputTokens': output_tokens, 'totalTokens': input_chars // 4 + 1 + output_tokens}
+
+    def _maybe_throttle(self, operation, started):
+        if self.rng.random() < self.throttle_rate:
+            self.stats.record(operation, time.perf_counter() - started, error=True)
+            raise client_error('ThrottlingException', operation)
+
+    def converse(self, **request):
+        started = time.perf_counter()
+        self._maybe_throttle('Converse', started)
+        time.sleep(self.latency + self.token_latency * self.chunks)
+        self.stats.record('Converse', time.perf_counter() - started)
+        return {
+            'output': {'message': {'role': 'assistant', 'content': [{'text': ''.join(self._reply())}]}},
+            'stopReason': 'end_turn',
+            'usage': self._usage(request),
+            'metrics': {'latencyMs': round((time.perf_counter() - started) * 1000)}
+        }
+
+    def converse_stream(self, **request):
+        started = time.perf_counter()
+        self._maybe_throttle('ConverseStream', started)
+        time.sleep(self.latency)
+        self.stats.record('ConverseStream', time.perf_counter() - started)
+        return {'stream': self._events(request, started)}
+
+    def _events(self, request, started):
+        yield {'messageStart': {'role': 'assistant'}}
+        for chunk in self._reply():
+            time.sleep(self.token_latency)
+            yield {'contentBlockDelta': {'delta': {'text': chunk}, 'contentBlockIndex': 0}}
+        yield {'contentBlockStop': {'contentBlockIndex': 0}}
+        yield {'messageStop': {'stopReason': 'end_turn'}}
+        yield {'metadata': {'usage': self._usage(request), 'metrics': {'latencyMs': round((time.perf_counter() - started) * 1000)}}}
+
+
+class FakeTable:
+    """In-memory DynamoDB table, supporting the key, filter, condition and update
+    expressions used by the bot, with injected latency and throttling"""
+
+    meta = None
+
+    def __init__(self, name='ChatHistory', latency=0.005, throttle_rate=0.0, rng=None):
+        self.name = name
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rng = rng or random.Random(0)
+        self.items = {}
+        self.lock = threading.Lock()
+        self.stats = CallStats()
+
+    def _call(self, operation):
+        started = time.perf_counter()
+        time.sleep(self.latency)
+        throttled = self.rng.random() < self.throttle_rate
+        self.stats.record(operation, time.perf_counter() - started, error=throttled)
+        if throttled:
+            raise client_error('ProvisionedThroughputExceededException', operation)
+
+    @staticmethod
+    def _key(item):
+        return (item['chat_id'], item['timestamp'])
+
+    def consume_read(self, items):
+        """Eventually consistent reads cost half a unit per 4KB read, rounded up over the call"""
+        size = sum(item_size(item) for item in items)
+        with self.stats.lock:
+            self.stats.capacity['ReadCapacityUnits'] += max(1, math.ceil(size / 4096)) * 0.5
+            self.stats.capacity['BytesRead'] += size
+
+    def consume_write(self, item, stored=True):
+        """Writes, and deletes, cost a unit per 1KB of the item"""
+        size = item_size(item) if item else 0
+        with self.stats.lock:
+            self.stats.capacity['WriteCapacityUnits'] += max(1, math.ceil(size / 1024))
+            if stored:
+                self.stats.capacity['BytesWritten'] += size
+
+    def get_item(self, Key, **kwargs):
+        self._call('GetItem')
+        with self.lock:
+            item = self.items.get(self._key(Key))
+        self.consume_read([item] if item else [])
+        return {'Item': copy.deepcopy(item)} if item else {}
+
+    def put_item(self, Item, ConditionExpression=None, **kwargs):
+        self._call('PutItem')
+        with self.lock:
+            if ConditionExpression == 'attribute_not_exists(chat_id)' and self._key(Item) in self.items:
+                raise client_error('ConditionalCheckFailedException', 'PutItem')
+            self.items[self._key(Item)] = copy.deepcopy(Item)
+        self.consume_write(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ExpressionAttributeNames=None, **kwargs):
+        self._call('UpdateItem')
+        names = ExpressionAttributeNames or {}
+        with self.lock:
+            item = self.items.setdefault(self._key(Key), dict(Key))
+            for name, value in re.findall(r'([#\w]+) = (:\w+)', UpdateExpression.split('SET', 1)[1]):
+                item[names.get(name, name)] = ExpressionAttributeValues[value]
+        self.consume_write(item)
+        return {}
+
+    def delete_item(self, Key, **kwargs):
+        self._call('DeleteItem')
+        with self.lock:
+            item = self.items.pop(self._key(Key), None)
+        self.consume_write(item, stored=False)
+        return {}
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames=None,
+              FilterExpression=None, ScanIndexForward=True, Limit=None, ExclusiveStartKey=None, **kwargs):
+        self._call('Query')
+        values = ExpressionAttributeValues
+        chat_id = values[re.match(r'chat_id = (:\w+)', KeyConditionExpression).group(1)]
+        with self.lock:
+            items = sorted((item for key, item in self.items.items() if key[0] == chat_id), key=lambda item: item['timestamp'])
+
+        if match := re.search(r'begins_with\(#?\w+, (:\w+)\)', KeyConditionExpression):
+            items = [item for item in items if item['timestamp'].startswith(values[match.group(1)])]
+        if not ScanIndexForward:
+            items.reverse()
+        if ExclusiveStartKey:
+            timestamps = [item['timestamp'] for item in items]
+            items = items[timestamps.index(ExclusiveStartKey['timestamp']) + 1:]
+
+        # Limit caps the items evaluated, before the filter is applied
+        response = {}
+        if Limit and len(items) > Limit:
+            items = items[:Limit]
+            response['LastEvaluatedKey'] = {'chat_id': chat_id, 'timestamp': items[-1]['timestamp']}
+        # Read capacity is for the whole items evaluated, whatever the projection and filter
+        self.consume_read(items)
+        if FilterExpression:
+            attribute, value = re.match(r'(\w+) = (:\w+)', FilterExpression).groups()
+            items = [item for item in items if item.get(attribute) == values[value]]
+        response['Items'] = copy.deepcopy(items)
+        return response
+
+
+class FakeDynamoDB:
+    """DynamoDB resource holding a single FakeTable, with BatchWriteItem support.
+
+    unprocessed_rate is the share of batch write requests returned as UnprocessedItems.
+    """
+
+    meta = None
+
+    def __init__(self, table, unprocessed_rate=0.0, rng=None):
+        self.table = table
+        self.unprocessed_rate = unprocessed_rate
+        self.rng = rng or random.Random(0)
+
+    def Table(self, name):
+        return self.table
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.table._call('BatchWriteItem')
+        unprocessed = []
+        for request in RequestItems[self.table.name]:
+            if self.rng.random() < self.unprocessed_rate:
+                unprocessed.append(request)
+                continue
+            with self.table.lock:
+                if 'PutRequest' in request:
+                    item = request['PutRequest']['Item']
+                    self.table.items[self.table._key(item)] = copy.deepcopy(item)
+                else:
+                    item = self.table.items.pop(self.table._key(request['DeleteRequest']['Key']), None)
+            self.table.consume_write(item, stored='PutRequest' in request)
+        return {'UnprocessedItems': {self.table.name: unprocessed} if unprocessed else {}}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """PTB request backend answering Bot API calls locally, without any network.
+
+    latency is added to every call, and error_rate of the calls fail with a server error.
+    Files are served from the files dict, by file_id. The text of each message sent or
+    edited is kept in the messages dict, by message_id.
+    """
+
+    def __init__(self, latency=0.02, error_rate=0.0, rng=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = rng or random.Random(0)
+        self.files = {}
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.message_id = 0
+        self.messages = {}
+        self.stats = CallStats()
+
+    def push_updates(self, updates):
+        """Queue updates for getUpdates"""
+        self.updates.extend(updates)
+        self.new_updates.set()
+
+    async def _wait_for_updates(self, parameters):
+        """Long poll: wait up to the getUpdates timeout for an update past the offset"""
+        offset = int(parameters.get('offset', 0))
+        if any(update['update_id'] >= offset for update in self.updates):
+            return
+        self.new_updates.clear()
+        try:
+            await asyncio.wait_for(self.new_updates.wait(), float(parameters.get('timeout', 0)))
+        except asyncio.TimeoutError:
+            pass
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        started = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        endpoint = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        if endpoint == 'getUpdates':
+            await self._wait_for_updates(parameters)
+
+        if '/file/bot' in url:
+            self.stats.record('downloadFile', time.perf_counter() - started)
+            return 200, self.files[endpoint]
+        if self.rng.random() < self.error_rate:
+            self.stats.record(endpoint, time.perf_counter() - started, error=True)
+            return 500, json.dumps({'ok': False, 'error_code': 500, 'description': 'Injected by the benchmark'}).encode()
+        self.stats.record(endpoint, time.perf_counter() - started)
+        return 200, json.dumps({'ok': True, 'result': self._result(endpoint, parameters)}).encode()
+
+    def _result(self, endpoint, parameters):
+        if endpoint == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        if endpoint in ('sendMessage', 'editMessageText'):
+            self.message_id += 1
+            message_id = int(parameters.get('message_id', self.message_id))
+            self.messages[message_id] = (int(parameters['chat_id']), parameters.get('text', ''))
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': parameters['chat_id'], 'type': 'private' if int(parameters['chat_id']) > 0 else 'group'},
+                'text': parameters.get('text', '')
+            }
+        if endpoint == 'getFile':
+            file_id = parameters['file_id']
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(self.files[file_id]), 'file_path': file_id}
+        if endpoint == 'getUpdates':
+            offset = int(parameters.get('offset', 0))
+            updates = [update for update in self.updates if update['update_id'] >= offset]
+            return updates[:int(parameters.get('limit', 100))]
+        return True
+
+
+def text_update(update_id, chat_id, text):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+        'from': {'id': abs(chat_id), 'is_bot': False, 'first_name': 'Benchmark'},
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def document_update(update_id, chat_id, file_id, size, file_name='notes.txt', mime_type='text/plain'):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': {'id': abs(chat_id), 'is_bot': False, 'first_name': 'Benchmark'},
+            'document': {'file_id': file_id, 'file_unique_id': file_id, 'file_name': file_name, 'mime_type': mime_type, 'file_size': size}
+        }
+    }
@@ -1,46 +1,223 @@
-import boto3
+import time
+# Milliseconds from the start of this module's import to each init stage, to catch cold start regressions
+init_started = time.perf_counter()
+init_timings = {}
+
+from botocore.exceptions import ClientError
 import json
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from telegram import Update
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
 from datetime import datetime, timedelta
 import os
-from aws_lambda_powertools.utilities import parameters
-import time
 import re
+import io
+import hashlib
+import zlib
+import tempfile
+import mmap
+import random
+import contextvars
+import traceback
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 
-bot = FastAPI()
+def mark_init(stage):
+    init_timings[stage] = round((time.perf_counter() - init_started) * 1000, 1)
+
+mark_init('imports')
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_bot()
+    await update_queue.start()
+    mark_init('ready')
+    print(f"Init timings (ms): {init_timings}")
+    yield
+    await update_queue.stop()
+    await stop_bot()
+
+async def start_bot(concurrent_updates=False):
+    """Load the secrets, and build and initialize the PTB application, once per process"""
+    global application
+    await run_aws(load_secrets)
+    mark_init('secrets')
+    # Register handlers and initialize PTB once per process, not on every update. The AWS
+    # clients are built at the same time, so the first update doesn't pay for them.
+    application = build_application(concurrent_updates)
+    register_handlers(application)
+    await asyncio.gather(application.initialize(), run_aws(warm_aws_clients))
+
+async def stop_bot():
+    """Finish the background work and the buffered writes, and shut down"""
+    await drain_background_tasks()
+    await write_buffer.flush()
+    await application.shutdown()
+    aws_executor.shutdown(wait=False)
+
+bot = FastAPI(lifespan=lifespan)
 
 @bot.get("/")
 def health_check():
     return {"status": "healthy", "message": "Telegram bot is running"}
 
 
-# Initialize SSM client
-ssm = boto3.client('ssm')
-# Initialize Bedrock client for synchronous operations
-bedrock = boto3.client('bedrock-runtime', region_name=os.environ.get('REGION', 'af-south-1'))
+# boto3 is synchronous, so AWS calls are offloaded to a bounded thread pool to keep
+# the event loop free. The connection pools are sized to match the number of workers.
+AWS_IO_WORKERS = int(os.environ.get('AWS_IO_WORKERS', '32'))
+aws_executor = ThreadPoolExecutor(max_workers=AWS_IO_WORKERS, thread_name_prefix='aws-io')
+
+def aws_client_config(**options):
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=AWS_IO_WORKERS,
+        tcp_keepalive=True,
+        retries={'max_attempts': 3, 'mode': 'standard'},
+        **options
+    )
+
+async def run_aws(func, *args, **kwargs):
+    """Run a blocking boto3 call on the AWS I/O thread pool"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(aws_executor, functools.partial(func, *args, **kwargs))
+
+class TTLCache:
+    """A small in-process LRU cache whose entries expire after ttl seconds"""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key):
+        self._entries.pop(key, None)
+
+
+class LazyClient:
+    """A boto3 client or resource that is built on first use, keeping boto3 out of the import"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+
+    def __getattr__(self, name):
+        if self._client is None:
+            self._client = self._factory()
+        return getattr(self._client, name)
+
+    def reset(self):
+        self._client = None
+
+def create_bedrock_client():
+    import boto3
+    # Model generations can take much longer than the default 60 second read timeout
+    return boto3.client('bedrock-runtime', region_name=os.environ.get('REGION', 'af-south-1'), config=aws_client_config(read_timeout=300))
+
+def create_dynamodb_resource():
+    import boto3
+    return boto3.resource('dynamodb', config=aws_client_config())
+
+# Initialize Bedrock client
+bedrock = LazyClient(create_bedrock_client)
 # Get table name from environment variable
 CHAT_HISTORY_TABLE = os.environ['CHATHISTORY_TABLE_NAME']
 # Initialize DynamoDB client
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(CHAT_HISTORY_TABLE)
+dynamodb = LazyClient(create_dynamodb_resource)
+table = LazyClient(lambda: dynamodb.Table(CHAT_HISTORY_TABLE))
+
+def warm_aws_clients():
+    for client in (bedrock, dynamodb, table):
+        # Any attribute access builds the client
+        client.meta
+
+try:
+    # Only available with SnapStart. Connections and credentials in the snapshot are stale
+    # after a restore, so the clients are built again.
+    from snapshot_restore_py import register_after_restore
 
-# Get the Telegram bot token from Parameter Store
-ssm_provider = parameters.SSMProvider()
-TelegramBotToken = ssm_provider.get('/bedrock-telegram-genai-chatbot/telegram/prod/bot_token', decrypt=True)
-TelegramBotAPISecretToken = ssm_provider.get('/bedrock-telegram-genai-chatbot/telegram/prod/api_secret_token', decrypt=True)
+    @register_after_restore
+    def reset_aws_clients():
+        for client in (bedrock, dynamodb, table):
+            client.reset()
+except ImportError:
+    pass
+
+# The Telegram bot token and API secret token
+TELEGRAM_PARAMETER_PATH = '/bedrock-telegram-genai-chatbot/telegram/prod'
+TelegramBotToken = None
+TelegramBotAPISecretToken = None
+
+def load_secrets():
+    """Get the Telegram tokens from the environment for local runs, or else from Parameter Store in one batched call"""
+    global TelegramBotToken, TelegramBotAPISecretToken
+    TelegramBotToken = os.environ.get('TELEGRAM_BOT_TOKEN')
+    TelegramBotAPISecretToken = os.environ.get('TELEGRAM_API_SECRET_TOKEN')
+    if TelegramBotToken and TelegramBotAPISecretToken:
+        return
+    from aws_lambda_powertools.utilities import parameters
+    values = parameters.get_parameters_by_name({
+        f'{TELEGRAM_PARAMETER_PATH}/bot_token': {},
+        f'{TELEGRAM_PARAMETER_PATH}/api_secret_token': {}
+    }, decrypt=True)
+    TelegramBotToken = values[f'{TELEGRAM_PARAMETER_PATH}/bot_token']
+    TelegramBotAPISecretToken = values[f'{TELEGRAM_PARAMETER_PATH}/api_secret_token']
 
-# Initialize PTB
-application = ApplicationBuilder().token(TelegramBotToken).build()
+# Bot API server to call instead of api.telegram.org, like a local Bot API server or a fake one
+TELEGRAM_BASE_URL = os.environ.get('TELEGRAM_BASE_URL')
+
+# Initialize PTB, once the tokens have been loaded
+application = None
+
+def build_application(concurrent_updates=False):
+    builder = ApplicationBuilder().token(TelegramBotToken).concurrent_updates(concurrent_updates)
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_BASE_URL}/bot").base_file_url(f"{TELEGRAM_BASE_URL}/file/bot")
+    return builder.build()
 
 #model_id = "us.anthropic.claude-sonnet-4-20250514-v1:0"
 #model_id = "us.anthropic.claude-sonnet-4-5-20250929-v1:0"
 #model_id = "af.anthropic.claude-sonnet-4-5-20250929-v1:0"
 model_id = "global.anthropic.claude-sonnet-4-5-20250929-v1:0"
 
+# Model ids or inference profiles to route requests between, most preferred first
+MODEL_IDS = [model.strip() for model in os.environ.get('MODEL_IDS', model_id).split(',') if model.strip()]
+# Errors after which a request is retried on the next model, which is rested for a while
+RETRYABLE_MODEL_ERRORS = ('ThrottlingException', 'ServiceUnavailableException', 'ModelNotReadyException')
+MODEL_COOLDOWN = float(os.environ.get('MODEL_COOLDOWN', '30'))
+# Seconds latency samples are ranked by. A model without recent samples is tried first
+# once per this period, so the latency of every model is kept up to date.
+MODEL_LATENCY_MAX_AGE = float(os.environ.get('MODEL_LATENCY_MAX_AGE', '300'))
+# Prompts up to this many characters are hedged: if the first model hasn't replied within
+# its p95 latency, the next model is asked too. 0 disables hedging.
+MODEL_HEDGE_MAX_CHARS = int(os.environ.get('MODEL_HEDGE_MAX_CHARS', '0'))
+# Model calls in flight at once, across all chats
+BEDROCK_MAX_IN_FLIGHT = int(os.environ.get('BEDROCK_MAX_IN_FLIGHT', '16'))
+# Answer messages sent while a turn of the same chat is running together, in one turn
+COALESCE_MESSAGES = os.environ.get('COALESCE_MESSAGES', 'false').lower() == 'true'
+MODEL_HEDGE_DELAY = float(os.environ.get('MODEL_HEDGE_DELAY', '2.0'))  # seconds, until there are latency samples
+
 # Inference parameters to use.
 temperature = 1 #0.5
 top_k = 200
@@ -55,51 +232,557 @@ additional_model_fields = {
     #"top_k": top_k
 }
 
-# Global variables for timing
-start_time = None
-lambda_context = None
+class ModelRouter:
+    """Route model calls to the healthiest of the configured model ids.
+
+    Keeps the recent latencies (from the Converse latencyMs metric) and throttling errors
+    of each model. Calls go to the model with the lowest p95 latency over the last
+    MODEL_LATENCY_MAX_AGE seconds that isn't resting after throttling, and fail over to the
+    next model on throttling errors. Models without recent samples are probed now and then.
+    """
+
+    def __init__(self, model_ids, window=100):
+        self.model_ids = model_ids
+        self.latencies = {model: deque(maxlen=window) for model in model_ids}  # (time, latency_ms)
+        self.throttles = {model: 0 for model in model_ids}
+        self.rested_until = {model: 0.0 for model in model_ids}
+        self.probed_at = {model: float('-inf') for model in model_ids}
+        self.active = model_ids[0]
+
+    def percentile(self, model, percent):
+        since = time.monotonic() - MODEL_LATENCY_MAX_AGE
+        latencies = sorted(latency for at, latency in self.latencies[model] if at >= since)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    def candidates(self):
+        """Models in the order to try them.
+
+        Rested models go last, and the others by p95 latency. Models without recent latency
+        samples come after the others, in configured order, except that one of them is
+        tried first once per MODEL_LATENCY_MAX_AGE to learn its latency.
+        """
+        now = time.monotonic()
+        p95s = {model: self.percentile(model, 95) for model in self.model_ids}
+        def rank(model):
+            return (self.rested_until[model] > now, p95s[model] if p95s[model] is not None else float('inf'))
+        ranked = sorted(self.model_ids, key=rank)
+        for model in ranked:
+            if (p95s[model] is None and self.rested_until[model] <= now
+                    and now - self.probed_at[model] >= MODEL_LATENCY_MAX_AGE):
+                self.probed_at[model] = now
+                ranked.remove(model)
+                ranked.insert(0, model)
+                break
+        return ranked
+
+    def record_latency(self, model, latency_ms):
+        self.latencies[model].append((time.monotonic(), latency_ms))
+        self.active = model
+
+    def record_error(self, model, error):
+        if error.response['Error']['Code'] not in RETRYABLE_MODEL_ERRORS:
+            return False
+        print(f"Model {model} failed with {error.response['Error']['Code']}, resting it for {MODEL_COOLDOWN} seconds")
+        self.throttles[model] += 1
+        record_metric('ModelThrottled', 1)
+        self.rested_until[model] = time.monotonic() + MODEL_COOLDOWN
+        return True
+
+    async def _converse(self, model, request):
+        await model_slots.acquire()
+        call = asyncio.ensure_future(run_aws(bedrock.converse, modelId=model, **request))
+        # A cancelled call (like the slower of two hedged ones) keeps running on its thread,
+        # so its slot is only released once the call returns
+        call.add_done_callback(release_model_slot)
+        try:
+            response = await asyncio.shield(call)
+        except ClientError as e:
+            self.record_error(model, e)
+            raise
+        self.record_latency(model, response['metrics']['latencyMs'])
+        return response
+
+    async def converse(self, hedge=False, **request):
+        """Call the Converse API on the healthiest model, failing over on throttling"""
+        candidates = self.candidates()
+        if hedge and len(candidates) > 1:
+            return await self._hedged_converse(candidates, request)
+        for model in candidates:
+            try:
+                return await self._converse(model, request)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in RETRYABLE_MODEL_ERRORS or model == candidates[-1]:
+                    raise
+
+    async def _hedged_converse(self, candidates, request):
+        first = asyncio.create_task(self._converse(candidates[0], request))
+        p95 = self.percentile(candidates[0], 95)
+        done, tasks = await asyncio.wait({first}, timeout=p95 / 1000 if p95 else MODEL_HEDGE_DELAY)
+        # The next model is only asked when the first one is slow or throttled. Other errors,
+        # like an invalid request, would fail there too.
+        error = first.exception() if done else None
+        if done and not (isinstance(error, ClientError) and error.response['Error']['Code'] in RETRYABLE_MODEL_ERRORS):
+            return first.result()
+        # Hedged with the next model, and on throttling with the one after it
+        hedges = iter(candidates[1:])
+        def hedge(model):
+            print(f"Hedging the request to {candidates[0]} with {model}")
+            tasks.add(asyncio.create_task(self._converse(model, request)))
+        hedge(next(hedges))
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    # The slower call still completes on its thread, its result is dropped
+                    for pending in tasks:
+                        pending.cancel()
+                    return task.result()
+                error = task.exception()
+                if isinstance(error, ClientError) and error.response['Error']['Code'] in RETRYABLE_MODEL_ERRORS:
+                    if (model := next(hedges, None)) is not None:
+                        hedge(model)
+        raise error
+
+    async def converse_stream(self, **request):
+        """Call the ConverseStream API on the healthiest model, failing over on throttling.
+
+        Returns the model used and the stream. Its latency is recorded by the caller,
+        once the stream metadata has been read.
+        """
+        candidates = self.candidates()
+        for model in candidates:
+            try:
+                return model, await run_aws(bedrock.converse_stream, modelId=model, **request)
+            except ClientError as e:
+                if not self.record_error(model, e) or model == candidates[-1]:
+                    raise
+
+    def status(self):
+        lines = [f"Active model: {self.active}"]
+        for model in self.model_ids:
+            p50, p95 = self.percentile(model, 50), self.percentile(model, 95)
+            latency = f"p50 {p50}ms, p95 {p95}ms" if p50 is not None else "no recent calls"
+            lines.append(f"{model}: {latency}, {self.throttles[model]} throttled")
+        return "\n".join(lines)
+
+
+router = ModelRouter(MODEL_IDS)
+
+def release_model_slot(call):
+    model_slots.release()
+    if not call.cancelled():
+        # Retrieved, so that the error of a call nobody waits for anymore isn't logged as unhandled
+        call.exception()
+
+# Caps the model calls in flight across all chats. Waiters get a slot in FIFO order, and
+# with the turns of each chat serialized, each chat has at most one turn waiting, so a
+# busy chat can't crowd out the others.
+model_slots = asyncio.Semaphore(BEDROCK_MAX_IN_FLIGHT)
+chat_locks = {}
+chat_lock_users = {}
+# Per chat, the messages waiting to be answered together in the next turn, and a future
+# with the error of that turn (None once it succeeded)
+pending_messages = {}
+
+@asynccontextmanager
+async def chat_turn(chat_id):
+    """Run one turn of a chat at a time, so turns read and write the chat history in order"""
+    lock = chat_locks.setdefault(chat_id, asyncio.Lock())
+    chat_lock_users[chat_id] = chat_lock_users.get(chat_id, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        chat_lock_users[chat_id] -= 1
+        if not chat_lock_users[chat_id]:
+            del chat_lock_users[chat_id]
+            del chat_locks[chat_id]
+
+# Add prompt cache points after the system prompt and the replayed chat history.
+# Prefixes shorter than the model's minimum cacheable length are not cached.
+PROMPT_CACHING = os.environ.get('PROMPT_CACHING', 'false').lower() == 'true'
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+# Opt-in cache of the responses to repeated one-shot prompts, for RESPONSE_CACHE_TTL seconds.
+# Only turns without history are cached: the first message of a chat, or one matching
+# STATELESS_PROMPT_PATTERN, which is answered without the conversation. The current time
+# sent with these turns is rounded down to RESPONSE_CACHE_TIME_BUCKET seconds, so that
+# repeats within the bucket match.
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', '0'))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '512'))
+RESPONSE_CACHE_TIME_BUCKET = int(os.environ.get('RESPONSE_CACHE_TIME_BUCKET', '3600'))
+STATELESS_PROMPT_PATTERN = os.environ.get('STATELESS_PROMPT_PATTERN')
+
+# Stream replies with ConverseStream, progressively editing a placeholder message
+STREAM_RESPONSES = os.environ.get('STREAM_RESPONSES', 'true').lower() == 'true'
+# Minimum seconds between edits of a streamed message. Telegram limits group chats
+# to about 20 messages per minute, so they are edited less often.
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', '1.0'))
+STREAM_GROUP_EDIT_INTERVAL = float(os.environ.get('STREAM_GROUP_EDIT_INTERVAL', '3.0'))
+# Telegram rejects messages longer than this
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Chat messages are stored with a sort key prefix, so they can be range queried
+# without a filter over the settings records in the same partition. The rest of the sort
+# key is the zero padded epoch time in microseconds, which sorts in time order.
+MESSAGE_KEY_PREFIX = 'M#'
+# Messages were stored with an ISO timestamp sort key before. They are read after the
+# newer messages until READ_LEGACY_MESSAGES=false (they expire after an hour).
+LEGACY_MESSAGE_KEY_PREFIX = 'MSG#'
+READ_LEGACY_MESSAGES = os.environ.get('READ_LEGACY_MESSAGES', 'true').lower() == 'true'
+# Message and document analysis text over this many bytes is stored zlib compressed, in a
+# binary <attribute>_z attribute, to save capacity units. 0 turns compression off.
+CONTENT_COMPRESSION_THRESHOLD = int(os.environ.get('CONTENT_COMPRESSION_THRESHOLD', '1024'))
+# Limits on the chat history sent to the model with each message
+HISTORY_MAX_TURNS = int(os.environ.get('HISTORY_MAX_TURNS', '40'))
+HISTORY_MAX_CHARS = int(os.environ.get('HISTORY_MAX_CHARS', '60000'))  # about 15k tokens
+HISTORY_PAGE_SIZE = int(os.environ.get('HISTORY_PAGE_SIZE', '20'))
+# Sort key of the single settings item of each chat
+SETTINGS_KEY = 'SETTINGS'
+# Sort key of the rolling summary of the older messages of each chat
+SUMMARY_KEY = 'SUMMARY'
+# Once the messages since the last summary are over this many characters, all but the
+# most recent COMPACT_KEEP_TURNS of them are folded into the summary
+COMPACT_THRESHOLD_CHARS = int(os.environ.get('COMPACT_THRESHOLD_CHARS', '24000'))
+COMPACT_KEEP_TURNS = int(os.environ.get('COMPACT_KEEP_TURNS', '10'))
+COMPACT_MAX_TURNS = int(os.environ.get('COMPACT_MAX_TURNS', '200'))
+# Compaction is a model call of its own, which a sync webhook waits for before it responds.
+# It is left to a later turn with less than this many milliseconds left.
+COMPACT_MIN_TIME_MS = int(os.environ.get('COMPACT_MIN_TIME_MS', '20000'))
+# Seconds a warm process may serve settings changed by another process
+SETTINGS_CACHE_TTL = float(os.environ.get('SETTINGS_CACHE_TTL', '30'))
+
+# Webhook ingestion mode. 'sync' processes each update before responding to Telegram,
+# 'async' queues the update and responds straight away.
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'sync')
+# Number of updates processed at the same time from the update queue
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', '8'))
+# SQS queue for updates in async mode. Without one, updates are queued in memory.
+UPDATE_QUEUE_URL = os.environ.get('UPDATE_QUEUE_URL')
+# Queued updates come back through the /events route, which the Lambda Web Adapter passes
+# SQS events to. It isn't checked for the secret token, so it only exists on Lambda, where
+# API Gateway only routes /bot to the app.
+RUNNING_ON_LAMBDA = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ
+
+# Documents up to this size are sent to the model inline (4.5MB)
+SIZE_LIMIT = 4.5 * 1024 * 1024
+# Larger PDF and TXT files are split into parts, up to DOCUMENT_MAX_SIZE. They are downloaded
+# to a temporary file, and the parts read from it as they are analyzed. The Telegram Bot
+# API only serves files up to 20MB, unless a local Bot API server is used.
+CHUNKED_DOCUMENT_TYPES = ('application/pdf', 'text/plain')
+DOCUMENT_MAX_SIZE = int(os.environ.get('DOCUMENT_MAX_SIZE', str(20 * 1024 * 1024)))
+DOCUMENT_CHUNK_PAGES = int(os.environ.get('DOCUMENT_CHUNK_PAGES', '50'))
+DOCUMENT_CHUNK_SIZE = int(os.environ.get('DOCUMENT_CHUNK_SIZE', str(512 * 1024)))  # bytes of text, about 130k tokens
+DOCUMENT_CHUNK_CONCURRENCY = int(os.environ.get('DOCUMENT_CHUNK_CONCURRENCY', '4'))
+# Analyzing a large document takes many model calls, more than fit in a sync webhook. They
+# are only analyzed without a deadline (from the in-memory queue or the poller), or with at
+# least this many milliseconds left. Updates with a large document that arrive with less
+# time left are handed off to DOCUMENT_QUEUE_URL, which a function with a longer timeout
+# consumes.
+LARGE_DOCUMENT_MIN_TIME_MS = int(os.environ.get('LARGE_DOCUMENT_MIN_TIME_MS', '300000'))
+DOCUMENT_QUEUE_URL = os.environ.get('DOCUMENT_QUEUE_URL')
+
+# Seconds to keep cached document analyses
+DOCUMENT_CACHE_TTL = int(os.environ.get('DOCUMENT_CACHE_TTL', str(24 * 3600)))
+
+# Seconds to remember processed Telegram update_ids, to skip redelivered updates
+UPDATE_DEDUP_TTL = int(os.environ.get('UPDATE_DEDUP_TTL', '3600'))
+
+# Batches of 25 deletes (the BatchWriteItem maximum) in flight while clearing a chat, and
+# attempts to write the items DynamoDB returns as unprocessed
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_CONCURRENCY = int(os.environ.get('BATCH_WRITE_CONCURRENCY', '4'))
+BATCH_WRITE_ATTEMPTS = int(os.environ.get('BATCH_WRITE_ATTEMPTS', '8'))
+
+# Chat messages and settings are buffered, and written with BatchWriteItem once this many
+# items are buffered or the oldest has waited this many seconds
+WRITE_BUFFER_MAX_ITEMS = int(os.environ.get('WRITE_BUFFER_MAX_ITEMS', '25'))
+WRITE_BUFFER_MAX_DELAY = float(os.environ.get('WRITE_BUFFER_MAX_DELAY', '1.0'))
+
+# Per update metrics, emitted as one CloudWatch Embedded Metric Format (EMF) log line
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'TelegramGenAIChatbot')
+
+# Share of updates and model responses logged in full
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.01'))
+
+class RequestMetrics:
+    """Stage durations, token counts and cache hits of one update, by metric name"""
+
+    def __init__(self):
+        self.update_type = 'webhook'
+        self.values = {}
+        self.properties = {}
+
+    def add(self, name, value, unit='Count'):
+        self.values[name] = (self.values.get(name, (0, unit))[0] + value, unit)
+
+    def timings(self):
+        return {name: round(value, 1) for name, (value, unit) in self.values.items() if unit == 'Milliseconds'}
+
+    def emit(self):
+        if not METRICS_ENABLED or not self.values:
+            return
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['UpdateType']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in self.values.items()]
+                }]
+            },
+            'UpdateType': self.update_type,
+            **{name: round(value, 1) for name, (value, unit) in self.values.items()},
+            **self.properties
+        }))
+
+request_metrics = contextvars.ContextVar('request_metrics', default=None)
+
+@contextmanager
+def metrics_scope():
+    """Collect the metrics of the code inside, emitting them on exit. Nested scopes share the outer one."""
+    metrics = request_metrics.get()
+    if metrics is not None:
+        yield metrics
+        return
+    metrics = RequestMetrics()
+    token = request_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        request_metrics.reset(token)
+        metrics.emit()
+
+def record_metric(name, value, unit='Count'):
+    metrics = request_metrics.get()
+    if metrics is not None:
+        metrics.add(name, value, unit)
+
+@contextmanager
+def span(name):
+    """Add the milliseconds spent inside to the name metric of the current update"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_metric(name, (time.perf_counter() - started) * 1000, 'Milliseconds')
+
+async def timed(name, awaitable):
+    with span(name):
+        return await awaitable
+
+def record_usage(usage):
+    """Record the token counts of a Converse usage block"""
+    record_metric('InputTokens', usage.get('inputTokens', 0))
+    record_metric('OutputTokens', usage.get('outputTokens', 0))
+    record_metric('CacheReadTokens', usage.get('cacheReadInputTokens', 0))
+    record_metric('CacheWriteTokens', usage.get('cacheWriteInputTokens', 0))
+
+def log_sampled(kind, payload):
+    """Log a payload as a JSON line, for a LOG_SAMPLE_RATE share of the calls"""
+    if random.random() < LOG_SAMPLE_RATE:
+        print(json.dumps({'log': kind, 'payload': payload}, default=str))
+
+# Milliseconds to allow a request when the Lambda Web Adapter doesn't pass the invocation deadline
+DEFAULT_REQUEST_TIMEOUT_MS = int(os.environ.get('DEFAULT_REQUEST_TIMEOUT_MS', '30000'))
+
+# Below this many milliseconds left in the invocation, a turn is trimmed to finish in time:
+# thinking is turned off, less history is sent, and the reply is streamed
+LOW_TIME_MS = int(os.environ.get('LOW_TIME_MS', '15000'))
+LOW_TIME_HISTORY_TURNS = int(os.environ.get('LOW_TIME_HISTORY_TURNS', '10'))
+
+class RequestContext:
+    """Start time, deadline and Lambda details of the request being handled"""
+
+    def __init__(self, deadline_ms=None, function_version='unknown', request_id=None):
+        self.started = time.perf_counter()
+        self.deadline_ms = deadline_ms
+        self.function_version = function_version
+        self.request_id = request_id
+
+    @classmethod
+    def from_headers(cls, headers):
+        """Read the invocation details from the x-amzn-lambda-context header added by the Lambda Web Adapter"""
+        try:
+            invocation = json.loads(headers['x-amzn-lambda-context'])
+            return cls(invocation['deadline'], invocation.get('env_config', {}).get('version', 'unknown'), invocation.get('request_id'))
+        except (KeyError, ValueError, TypeError):
+            return cls(time.time() * 1000 + DEFAULT_REQUEST_TIMEOUT_MS)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def remaining_ms(self):
+        """Milliseconds left until the deadline, or None without one"""
+        if self.deadline_ms is None:
+            return None
+        return max(0, self.deadline_ms - time.time() * 1000)
+
+# Set for each webhook and SQS request. Updates processed outside of one (like the
+# in-process update workers) have no deadline.
+request_context = contextvars.ContextVar('request_context', default=None)
+
+def time_is_low():
+    remaining = request_context.get().remaining_ms() if request_context.get() else None
+    return remaining is not None and remaining < LOW_TIME_MS
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    current_time = time.perf_counter()
-    execution_duration = current_time - start_time if start_time else 0
-    remaining_time = lambda_context.get_remaining_time_in_millis() / 1000 if lambda_context else 0
-    function_version = lambda_context.function_version if lambda_context else "unknown"
+    request = request_context.get() or RequestContext()
+    remaining_ms = request.remaining_ms()
+    remaining_time = f"{remaining_ms / 1000:.3f} seconds" if remaining_ms is not None else "no deadline"
     
     await update.message.reply_text(
         f"Bot is running!\n"
-        f"Function version: {function_version}\n"
-        f"Execution duration: {execution_duration:.3f} seconds\n"
-        f"Remaining time until timeout: {remaining_time:.3f} seconds"
+        f"Function version: {request.function_version}\n"
+        f"Execution duration: {request.elapsed():.3f} seconds\n"
+        f"Remaining time until timeout: {remaining_time}\n"
+        f"{router.status()}\n"
+        f"Init timings (ms): {init_timings}"
     )
 
 
-async def get_chat_history(chat_id):
-    response = table.query(
-            KeyConditionExpression='chat_id = :chat_id',
-            FilterExpression='record_type = :type',
-            ExpressionAttributeValues={
+async def get_chat_history(chat_id, max_turns=HISTORY_MAX_TURNS, max_chars=HISTORY_MAX_CHARS, after=None):
+    """Get the most recent chat messages for a chat, newest first.
+
+    Messages are read in pages, newest first, until the turn cap or character budget is
+    reached, so read capacity and model input stay flat for long conversations. Messages
+    up to the sort key after (already folded into the chat summary) are not read. Query
+    errors are raised rather than returning a partial history. Messages still in the write
+    buffer are merged in, so a turn always sees the previous one.
+    """
+    history = []
+    history_chars = 0
+    buffered = write_buffer.pending(chat_id, MESSAGE_KEY_PREFIX)
+    seen = set()
+
+    def add(item):
+        """Add the next older message, returning False once the history is complete"""
+        nonlocal history_chars
+        if after and message_order(item['timestamp']) <= message_order(after):
+            return False
+        if item['timestamp'] in seen:
+            # Written out by the buffer while this history was being read
+            return True
+        history_chars += len(item['content'])
+        if len(history) >= max_turns or history_chars > max_chars:
+            print(f"Chat history truncated to the most recent {len(history)} messages")
+            return False
+        seen.add(item['timestamp'])
+        history.append(item)
+        return True
+
+    for prefix in message_key_prefixes(chat_id, after):
+        query = {
+            'KeyConditionExpression': 'chat_id = :chat_id AND begins_with(#ts, :prefix)',
+            'ExpressionAttributeNames': {'#ts': 'timestamp'},
+            'ExpressionAttributeValues': {
                 ':chat_id': str(chat_id),
-                ':type': 'CHAT_MESSAGE'
+                ':prefix': prefix
             },
-            ScanIndexForward=False  # This will get the most recent messages first
-        )
-    return response.get('Items', [])
+            'ScanIndexForward': False,  # This will get the most recent messages first
+            'Limit': min(HISTORY_PAGE_SIZE, max_turns + 1)
+        }
+        while True:
+            response = await run_aws(table.query, **query)
+            if prefix == LEGACY_MESSAGE_KEY_PREFIX and not response.get('Items') and 'ExclusiveStartKey' not in query:
+                chats_without_legacy_messages.set(str(chat_id), True)
+            for item in response.get('Items', []):
+                while buffered and message_order(buffered[0]['timestamp']) > message_order(item['timestamp']):
+                    if not add(decode_message(buffered.pop(0))):
+                        return trim_history(history)
+                if not add(decode_message(item)):
+                    return trim_history(history)
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    for item in buffered:
+        if not add(decode_message(item)):
+            break
+    return trim_history(history)
+
+# Chats found to have no legacy messages. None are written anymore, so they aren't read again.
+chats_without_legacy_messages = TTLCache(maxsize=10000, ttl=24 * 3600)
 
-async def save_message(chat_id, role, content):
+def message_key_prefixes(chat_id, after=None):
+    """Sort key prefixes of the messages to read, newest messages first. Legacy messages
+    are skipped when the chat has none, or the chat summary already covers a newer message."""
+    if (READ_LEGACY_MESSAGES and chats_without_legacy_messages.get(str(chat_id)) is None
+            and not (after and after.startswith(MESSAGE_KEY_PREFIX))):
+        return [MESSAGE_KEY_PREFIX, LEGACY_MESSAGE_KEY_PREFIX]
+    return [MESSAGE_KEY_PREFIX]
+
+def message_order(timestamp):
+    """Epoch microseconds of a message sort key, in either the current or the legacy format"""
+    if timestamp.startswith(LEGACY_MESSAGE_KEY_PREFIX):
+        sent = datetime.fromisoformat(timestamp[len(LEGACY_MESSAGE_KEY_PREFIX):])
+        return (sent - datetime(1970, 1, 1)) // timedelta(microseconds=1)
+    return int(timestamp[len(MESSAGE_KEY_PREFIX):])
+
+def encode_text(item, name, text):
+    """Set a text attribute of an item, compressed into name_z when it is large and compresses well"""
+    data = text.encode('utf-8')
+    if CONTENT_COMPRESSION_THRESHOLD and len(data) > CONTENT_COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            item[f'{name}_z'] = compressed
+            return
+    item[name] = text
+
+def decode_text(item, name):
+    """Read a text attribute of an item, stored either as is or compressed"""
+    if f'{name}_z' not in item:
+        return item.get(name)
+    # boto3 returns binary attributes wrapped in a Binary
+    compressed = item[f'{name}_z']
+    return zlib.decompress(getattr(compressed, 'value', compressed)).decode('utf-8')
+
+def decode_message(item):
+    """A copy of a message item with its text attributes decompressed"""
+    message = {name: value for name, value in item.items() if not name.endswith('_z')}
+    message['content'] = decode_text(item, 'content')
+    if 'reasoning_z' in item:
+        message['reasoning'] = decode_text(item, 'reasoning')
+    return message
+
+def trim_history(history):
+    """Drop the oldest messages until the conversation starts with a user message, as Converse requires"""
+    while history and history[-1]['role'] != 'user':
+        history.pop()
+    return history
+
+# Epoch microseconds of the last message saved, so that messages saved in the same
+# microsecond still get distinct sort keys, in order
+last_message_time = 0
+
+def save_message(chat_id, role, content, reasoning=None, reasoning_signature=None):
+    """Save a chat message, through the write buffer.
+
+    The model reasoning of an assistant message is stored apart from the reply text, as
+    only the reply is replayed to the model with later messages.
+    """
+    global last_message_time
     current_time = datetime.utcnow()
-    timestamp = current_time.isoformat()
+    last_message_time = max(time.time_ns() // 1000, last_message_time + 1)
+    timestamp = f"{MESSAGE_KEY_PREFIX}{last_message_time:016d}"
     
     # Calculate TTL (current time + 1 hour) in epoch seconds
     ttl = int((current_time + timedelta(hours=1)).timestamp())
     
-    table.put_item(Item={
+    item = {
         'chat_id': str(chat_id),
         'timestamp': timestamp,
         'record_type': 'CHAT_MESSAGE',  # Add record_type
         'role': role,
-        'content': content,
         'expireat': ttl  # TTL attribute
-    })
+    }
+    encode_text(item, 'content', content)
+    if reasoning:
+        encode_text(item, 'reasoning', reasoning)
+        item['reasoning_signature'] = reasoning_signature
+    write_buffer.put(item)
 
 
 
@@ -107,31 +790,93 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="I'm a GenAI chatbot, powered by Amazon Bedrock, running on AWS Serverless, please talk to me!")
 
 async def bedrock_converse(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print(update)
+    chat_id = update.effective_chat.id
+    user_message = update.message.text
+
+    if not COALESCE_MESSAGES:
+        async with chat_turn(chat_id):
+            await converse_turn(update, context, user_message)
+        return
+
+    # Messages sent while a turn of this chat is waiting are answered together in that turn
+    pending = pending_messages.get(chat_id)
+    if pending is not None:
+        print(f"Coalescing message into the next turn of chat {chat_id}")
+        pending['messages'].append(user_message)
+        # The update only succeeds with the turn answering it, so it is redelivered if that fails
+        error = await asyncio.shield(pending['done'])
+        if error is not None:
+            raise error
+        return
+
+    pending = pending_messages[chat_id] = {
+        'messages': [user_message], 'done': asyncio.get_running_loop().create_future()
+    }
+    error = None
+    try:
+        async with chat_turn(chat_id):
+            # Messages sent from here on wait for the turn after this one
+            del pending_messages[chat_id]
+            await converse_turn(update, context, "\n\n".join(pending['messages']))
+    except BaseException as e:
+        error = e if isinstance(e, Exception) else RuntimeError(f"turn of chat {chat_id} was cancelled")
+        raise
+    finally:
+        if pending_messages.get(chat_id) is pending:
+            del pending_messages[chat_id]
+        pending['done'].set_result(error)
+
+async def converse_turn(update: Update, context: ContextTypes.DEFAULT_TYPE, user_message):
+    log_sampled('update', update.to_dict())
     messages = []
     
     chat_id = update.effective_chat.id
-    user_message = update.message.text
-    current_time = await get_current_datetime()
     #print(user_message)
 
-    # Get recent chat history
-    chat_history = await get_chat_history(chat_id)
-   
-   # Save user message
-    await save_message(chat_id, 'user', user_message)
+    # Pre-model stage: get the chat settings and summary at the same time (both are
+    # usually cached), then the recent chat history since the summary
+    settings, summary = await asyncio.gather(
+        timed('SettingsRead', get_chat_settings(chat_id)),
+        timed('SummaryRead', get_chat_summary(chat_id))
+    )
+    # Close to the timeout (e.g. after waiting for an earlier turn of the chat), the turn
+    # is trimmed so that a reply is sent in time
+    time_low = time_is_low()
+    if time_low:
+        print(f"Running low on time, trimming the turn of chat {chat_id}")
+        record_metric('LowTimeTurn', 1)
+    if is_stateless_prompt(user_message):
+        # Answered without the conversation, so that the response can be cached
+        chat_history, summary = [], {}
+    else:
+        max_turns = LOW_TIME_HISTORY_TURNS if time_low else HISTORY_MAX_TURNS
+        chat_history = await timed('HistoryRead', get_chat_history(chat_id, max_turns, after=summary.get('covers_until')))
+    thinking_enabled = settings.get('thinking_enabled', False) and not time_low
+    debug_enabled = settings.get('debug_enabled', False)
+    cacheable = RESPONSE_CACHE_TTL > 0 and not chat_history and not summary
+    current_time = await get_current_datetime(RESPONSE_CACHE_TIME_BUCKET if cacheable else None)
     
     # Build conversation context
-    conversation = ""
     for msg in reversed(chat_history):  # Oldest to newest
         conversation = {
             "role": msg['role'],
             "content": [{"text": msg['content']}]
             }
-        #print(conversation)
         messages.append(conversation)
 
-    # Add current time context to the user message
+    # Mark the end of the stable prefix (system prompt and replayed history), so Bedrock
+    # can reuse it from the prompt cache on the next turn
+    system = system_prompts
+    if summary:
+        # The summary stands in for the older messages that were folded into it
+        system = system + [{"text": f"This is a summary of the earlier conversation with the user:\n{summary['content']}"}]
+    if PROMPT_CACHING:
+        system = system + [CACHE_POINT]
+        if messages:
+            messages[-1] = {"role": messages[-1]["role"], "content": messages[-1]["content"] + [CACHE_POINT]}
+
+    # Add current time context to the user message. It changes every turn, so it is
+    # kept after the cache points.
     message = {
         "role": "user", 
         "content": [
@@ -140,11 +885,6 @@ async def bedrock_converse(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     
     messages.append(message)
-    #print(messages)
-
-    # Check thinking status
-    thinking_enabled = await get_thinking_status(chat_id)
-    print(f"Checking the thinking status before sending thinking messages: {thinking_enabled}")
     
     # Build additional model fields based on thinking status
     model_fields = {}
@@ -155,45 +895,207 @@ async def bedrock_converse(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }
     
     # Call Bedrock Converse API
-    response = bedrock.converse(
-        modelId=model_id,
-        messages=messages,
-        system=system_prompts,
-        inferenceConfig=inference_config,
-        additionalModelRequestFields=model_fields
-    )
-    print(response)
-    # Parse response
-    #response_body = json.loads(response['output'].read())
+    request = {
+        "messages": messages,
+        "system": system,
+        "inferenceConfig": inference_config,
+        "additionalModelRequestFields": model_fields
+    }
+    cache_key = response_cache_key(user_message, current_time, request) if cacheable else None
+    response = response_cache.get(cache_key) if cache_key else None
+    cache_status = 'off' if cache_key is None else 'miss' if response is None else 'hit'
+    if cache_key:
+        record_metric('ResponseCacheHit' if response else 'ResponseCacheMiss', 1)
+
+    stream_response = (STREAM_RESPONSES or time_low) and response is None
+    if response is None:
+        with span('Model'):
+            if stream_response:
+                # The reply is sent to telegram while it is being generated
+                response, ptb_response_message = await stream_converse(context, chat_id, request)
+            else:
+                # Short prompts can be hedged across models
+                prompt_chars = sum(len(block.get('text', '')) for msg in messages for block in msg['content'])
+                response = await router.converse(hedge=prompt_chars <= MODEL_HEDGE_MAX_CHARS, **request)
+        log_sampled('model_response', response)
+        record_usage(response['usage'])
+        # Truncated responses are not cached
+        if cache_key and response.get('stopReason') == 'end_turn':
+            response_cache.set(cache_key, response)
     
     # Parse response - response is already a dictionary
     content = response['output']['message']['content']
     
     # Extract reasoning and text content
-    reasoning = next((item['reasoningContent']['reasoningText']['text'] for item in content if 'reasoningContent' in item), "")
+    reasoning_text = next((item['reasoningContent']['reasoningText'] for item in content if 'reasoningContent' in item), {})
+    reasoning = reasoning_text.get('text', "")
     text_response = next((item['text'] for item in content if 'text' in item), "")
     
-    # Combine reasoning and response
-    bedrock_response = f"**Thinking:**\n{reasoning}\n\n**Response:**\n{text_response}" if reasoning else text_response
+    # Combine reasoning and response for display
+    bedrock_response = render_response(reasoning, text_response)
     
     bedrock_response_metrics = response['metrics']['latencyMs']
     bedrock_response_usage = response['usage']
 
-    # Save bedrock response
-    await save_message(chat_id, 'assistant', bedrock_response)
-
     # Send response to telegram
-    ptb_response_message = await context.bot.send_message(chat_id=update.effective_chat.id, text=bedrock_response)
+    if not stream_response:
+        ptb_response_message = await send_long_message(context, chat_id, bedrock_response)
+
+    # Post-reply stage: buffer the turn. It is written before the webhook responds. A turn
+    # that fails before this point is retried, so its user message isn't stored yet.
+    save_message(chat_id, 'user', user_message)
+    save_message(chat_id, 'assistant', text_response, reasoning, reasoning_text.get('signature'))
+
+    # Fold older messages into the summary once the reply has been sent, when the history
+    # read for this turn shows the messages since the summary are over the threshold, or
+    # more than the next turn can read
+    history_chars = sum(len(msg['content']) for msg in chat_history) + len(user_message) + len(text_response)
+    if history_chars > COMPACT_THRESHOLD_CHARS or len(chat_history) + 2 > HISTORY_MAX_TURNS:
+        run_in_background(compact_history(chat_id))
 
-    # Check debug status before sending debug message
-    debug_enabled = await get_debug_status(update.effective_chat.id)
-    print(f"Checking the debug status before sending debug messages: {debug_enabled}")
     if debug_enabled:
         await context.bot.send_message(
             chat_id=update.effective_chat.id, 
             reply_to_message_id=ptb_response_message.message_id, 
-            text=f"Debug: \n Bedrock Response time: {bedrock_response_metrics / 1000} sec \n Bedrock Usage: {bedrock_response_usage}"
+            text=f"Debug: \n Bedrock Response time: {bedrock_response_metrics / 1000} sec \n Bedrock Usage: {bedrock_response_usage} \n Prompt cache: {format_cache_usage(bedrock_response_usage)} \n Response cache: {cache_status} \n Stage timings (ms): {request_metrics.get().timings()}"
+        )
+
+
+response_cache = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+def is_stateless_prompt(user_message):
+    return bool(STATELESS_PROMPT_PATTERN) and re.fullmatch(STATELESS_PROMPT_PATTERN, user_message.strip(), re.IGNORECASE) is not None
+
+def response_cache_key(user_message, current_time, request):
+    """Key of a turn in the response cache: the normalized message, the time bucket, and the rest of the model request"""
+    return hashlib.sha256(json.dumps({
+        'message': ' '.join(user_message.casefold().split()),
+        'time': current_time,
+        'system': request['system'],
+        'models': MODEL_IDS,
+        'inferenceConfig': request['inferenceConfig'],
+        'additionalModelRequestFields': request['additionalModelRequestFields']
+    }, sort_keys=True).encode('utf-8')).hexdigest()
+
+def format_cache_usage(usage):
+    """Describe the prompt cache token counts of a Converse usage block"""
+    return f"{usage.get('cacheReadInputTokens', 0)} read, {usage.get('cacheWriteInputTokens', 0)} written"
+
+def render_response(reasoning, text_response):
+    """Format the model reasoning and reply for display in telegram"""
+    return f"**Thinking:**\n{reasoning}\n\n**Response:**\n{text_response}" if reasoning else text_response
+
+def split_message(text):
+    """Split text into chunks that fit in a single telegram message"""
+    return [text[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT)] or [""]
+
+async def replace_message_text(context, chat_id, message, text):
+    """Edit the text of a message, returning the message now holding the text.
+
+    The text is a generated reply, so a 429 is waited out once if the deadline allows, and
+    if the edit still fails the text is sent as a new message instead of failing the turn.
+    """
+    for attempt in range(2):
+        try:
+            await context.bot.edit_message_text(chat_id=chat_id, message_id=message.message_id, text=text)
+            return message
+        except RetryAfter as e:
+            remaining = request_context.get().remaining_ms() if request_context.get() else None
+            print(f"Edit of message {message.message_id} rate limited for {e.retry_after} seconds")
+            if attempt or (remaining is not None and e.retry_after * 1000 > remaining - LOW_TIME_MS):
+                break
+            await asyncio.sleep(e.retry_after)
+        except TelegramError as e:
+            print(f"Error editing message {message.message_id}: {e}")
+            break
+    return await context.bot.send_message(chat_id=chat_id, text=text)
+
+async def send_long_message(context, chat_id, text, message=None, shown_text=None):
+    """Send text as one or more telegram messages, returning the first one.
+
+    If message is given, its text (currently shown_text) is replaced with the first chunk
+    instead of sending a new message.
+    """
+    chunks = split_message(text)
+    with span('TelegramSend'):
+        if message is None:
+            message = await context.bot.send_message(chat_id=chat_id, text=chunks[0])
+        elif chunks[0] and chunks[0] != shown_text:
+            message = await replace_message_text(context, chat_id, message, chunks[0])
+        for chunk in chunks[1:]:
+            await context.bot.send_message(chat_id=chat_id, text=chunk)
+    return message
+
+async def stream_converse(context, chat_id, request):
+    """Call the ConverseStream API, editing a placeholder message as the reply is generated.
+
+    Edits are throttled to STREAM_EDIT_INTERVAL. Returns a response shaped like a Converse
+    API response, and the telegram message holding the reply.
+    """
+    edit_interval = STREAM_GROUP_EDIT_INTERVAL if chat_id < 0 else STREAM_EDIT_INTERVAL
+    with span('TelegramSend'):
+        message = await context.bot.send_message(chat_id=chat_id, text="...")
+    shown_text = message.text
+    reasoning, signature, text_response = [], [], []
+    response = {"usage": {}, "metrics": {"latencyMs": 0}}
+
+    try:
+        # The slot is held until the whole reply has been streamed
+        async with model_slots:
+            started = time.perf_counter()
+            model, stream = await router.converse_stream(**request)
+            events = iter(stream['stream'])
+            last_edit = time.perf_counter()
+            first_token = True
+            # Each read from the event stream blocks, so it is done on the AWS I/O pool
+            while (event := await run_aws(next, events, None)) is not None:
+                if 'contentBlockDelta' in event:
+                    if first_token:
+                        record_metric('ModelTimeToFirstToken', (time.perf_counter() - started) * 1000, 'Milliseconds')
+                        first_token = False
+                    delta = event['contentBlockDelta']['delta']
+                    if 'text' in delta:
+                        text_response.append(delta['text'])
+                    elif 'reasoningContent' in delta:
+                        reasoning.append(delta['reasoningContent'].get('text', ''))
+                        signature.append(delta['reasoningContent'].get('signature', ''))
+                elif 'messageStop' in event:
+                    response['stopReason'] = event['messageStop'].get('stopReason')
+                elif 'metadata' in event:
+                    response['usage'] = event['metadata'].get('usage', {})
+                    response['metrics'] = event['metadata'].get('metrics', {})
+
+                now = time.perf_counter()
+                if now - last_edit >= edit_interval:
+                    last_edit = now
+                    preview = render_response(''.join(reasoning), ''.join(text_response))[:TELEGRAM_MESSAGE_LIMIT]
+                    if preview.strip() and preview != shown_text:
+                        try:
+                            with span('TelegramSend'):
+                                await context.bot.edit_message_text(chat_id=chat_id, message_id=message.message_id, text=preview)
+                            shown_text = preview
+                        except TelegramError as e:
+                            # Progress edits are best effort, the whole reply is sent once generated
+                            print(f"Skipped a progress edit: {e}")
+                            if isinstance(e, RetryAfter):
+                                last_edit = now + e.retry_after
+    except Exception:
+        await context.bot.edit_message_text(
+            chat_id=chat_id,
+            message_id=message.message_id,
+            text="Sorry, I encountered an error while generating a response."
         )
+        raise
+    router.record_latency(model, response['metrics'].get('latencyMs', 0))
+
+    content = []
+    if reasoning:
+        content.append({"reasoningContent": {"reasoningText": {"text": ''.join(reasoning), "signature": ''.join(signature)}}})
+    content.append({"text": ''.join(text_response)})
+    response['output'] = {"message": {"role": "assistant", "content": content}}
+
+    message = await send_long_message(context, chat_id, render_response(''.join(reasoning), ''.join(text_response)), message, shown_text)
+    return response, message
     
 
 def sanitize_filename(filename):
@@ -214,6 +1116,10 @@ def sanitize_filename(filename):
 
 
 async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    async with chat_turn(update.effective_chat.id):
+        await document_turn(update, context)
+
+async def document_turn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print("Start processing document: ")
     
     chat_id = update.effective_chat.id
@@ -222,15 +1128,23 @@ async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     file_name = document.file_name
     file_size = document.file_size  # Size in bytes
     
-    # Define size limit (4.5MB in bytes)
-    SIZE_LIMIT = 4.5 * 1024 * 1024  # 4.5MB in bytes
+    # PDF and TXT files above the inline limit are analyzed in chunks
+    max_size = DOCUMENT_MAX_SIZE if mime_type in CHUNKED_DOCUMENT_TYPES else SIZE_LIMIT
     
     # Check file size
-    if file_size > SIZE_LIMIT:
+    if file_size > max_size:
         size_mb = file_size / (1024 * 1024)  # Convert to MB for user-friendly message
         print("file too large")
         # Send response to telegram
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"File is too large ({size_mb:.2f}MB). Maximum allowed size is 4.5MB. Please upload a smaller file."
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"File is too large ({size_mb:.2f}MB). Maximum allowed size is {max_size / (1024 * 1024):.1f}MB. Please upload a smaller file."
+        )
+        return
+
+    # Check there is time to analyze a large document in parts
+    remaining_ms = request_context.get().remaining_ms() if request_context.get() else None
+    if file_size > SIZE_LIMIT and remaining_ms is not None and remaining_ms < LARGE_DOCUMENT_MIN_TIME_MS:
+        print(f"Not enough time left for a large document: {remaining_ms:.0f} ms")
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Documents over {SIZE_LIMIT / (1024 * 1024):.1f}MB take longer to analyze than this bot can spend on a message. Please upload a smaller file."
         )
         return
 
@@ -270,70 +1184,39 @@ async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     
-    try:
-        # Get the file
-        file = await context.bot.getFile(document.file_id)
-        file_type = supported_types[mime_type]
-        temp_file_path = f'/tmp/doc{file_type["extension"]}'
-        
-        # Download the file
-        await file.download_to_drive(temp_file_path)
-        
-        # Read the file contents
-        with open(temp_file_path, 'rb') as doc:
-            doc_contents = doc.read()
-        
-        print(f"Successfully saved document as {file_type['type']}")
+    file_type = supported_types[mime_type]
+    file_key = f"file:{document.file_unique_id}"
 
-                # Sanitize the filename for Bedrock
-        sanitized_name = sanitize_filename(file_name)
-        print(f"Sanitized filename: {sanitized_name}")
-        
-        # Ensure we have a valid filename after sanitization
-        if not sanitized_name:
-            sanitized_name = "document"
+    try:
+        # Forwarded documents have the same file_unique_id, so a repeat skips the download
+        analysis = await get_cached_analysis(file_key)
 
-        
-        # Prepare messages for Bedrock Converse API
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "text": f"Please analyze this document"
-                    },
-                    {
-                        "document": {
-                            "format": file_type['extension'].lstrip('.'),
-                            "name": sanitized_name,
-                            "source": {
-                                "bytes": doc_contents
-                            },
-                        "citations": {
-                            "enabled": True
-                        }
-                        }
-                    }
-                ]
-            }
-        ]
+        if analysis is None:
+            # Get the file
+            file = await context.bot.getFile(document.file_id)
+            
+            # Download the file contents
+            async with downloaded_document(file, file_size) as doc_contents:
+                print(f"Successfully downloaded document as {file_type['type']}")
 
-        # Use the converse API with direct parameters
-        response = bedrock.converse(
-            modelId=model_id,
-            messages=messages
-        )
-        
-        # Extract the text from the response
-        bedrock_response = response['output']['message']['content'][0]['text']
-        bedrock_response_metrics = response['metrics']['latencyMs']
-        bedrock_response_usage = response['usage']
+                # The same contents may have been uploaded as a different file
+                content_key = f"sha256:{hashlib.sha256(doc_contents).hexdigest()}"
+                analysis = await get_cached_analysis(content_key)
+                if analysis is None:
+                    document_cache_stats['misses'] += 1
+                    record_metric('DocumentCacheMiss', 1)
+                    with span('Model'):
+                        if file_size > SIZE_LIMIT:
+                            analysis = await analyze_large_document(context, chat_id, doc_contents, file_type, file_name)
+                        else:
+                            analysis = await analyze_document(doc_contents, file_type, file_name)
+                    record_usage(analysis['usage'])
+                    await timed('Persist', save_cached_analysis([file_key, content_key], analysis))
+                else:
+                    await timed('Persist', save_cached_analysis([file_key], analysis))
 
         # Send response to telegram
-        ptb_response_message = await context.bot.send_message(
-            chat_id=chat_id, 
-            text=bedrock_response
-        )
+        ptb_response_message = await send_long_message(context, chat_id, analysis['text'])
 
         # Check debug status before sending debug message
         debug_enabled = await get_debug_status(update.effective_chat.id)
@@ -342,18 +1225,263 @@ async def document_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await context.bot.send_message(
                 chat_id=chat_id, 
                 reply_to_message_id=ptb_response_message.message_id, 
-                text=f"Debug: \n Bedrock Response time: {bedrock_response_metrics / 1000} sec \n Bedrock Usage: {bedrock_response_usage}"
+                text=f"Debug: \n Bedrock Response time: {analysis['latency_ms'] / 1000} sec \n Bedrock Usage: {analysis['usage']} \n Document cache: {format_document_cache_stats()}"
             )
         
     except Exception as e:
         error_message = f"Error processing document: {str(e)}"
         print(error_message)
         await context.bot.send_message(chat_id=chat_id, text=error_message)
+
+async def analyze_document(doc_contents, file_type, file_name, prompt="Please analyze this document"):
+    """Ask the model to analyze a document, returning the analysis text, latency and usage"""
+    # Sanitize the filename for Bedrock
+    sanitized_name = sanitize_filename(file_name)
+    print(f"Sanitized filename: {sanitized_name}")
     
-    finally:
-        # Cleanup: Remove temporary file if it exists
-        if 'temp_file_path' in locals() and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+    # Ensure we have a valid filename after sanitization
+    if not sanitized_name:
+        sanitized_name = "document"
+
+    # Prepare messages for Bedrock Converse API
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "text": prompt
+                },
+                {
+                    "document": {
+                        "format": file_type['extension'].lstrip('.'),
+                        "name": sanitized_name,
+                        "source": {
+                            "bytes": doc_contents
+                        },
+                    "citations": {
+                        "enabled": True
+                    }
+                    }
+                }
+            ]
+        }
+    ]
+
+    # Use the converse API with direct parameters
+    response = await router.converse(messages=messages)
+    
+    # Extract the text from the response. With citations, the text is split into several blocks.
+    content = response['output']['message']['content']
+    return {
+        'text': ''.join(item['text'] for item in content if 'text' in item),
+        'latency_ms': response['metrics']['latencyMs'],
+        'usage': response['usage']
+    }
+
+
+def document_chunks(doc_contents, file_type):
+    """Split a PDF by pages, or a TXT file by lines, into parts small enough to analyze inline.
+
+    PDF parts have up to DOCUMENT_CHUNK_PAGES pages, and are closed before they pass
+    SIZE_LIMIT. A single page over SIZE_LIMIT raises ValueError.
+
+    doc_contents is the bytes of the document or a memory map of it. Returns the number of
+    parts, and an iterator that builds the parts as they are needed.
+    """
+    if file_type['type'] == 'PDF':
+        # Only needed for large PDFs, so imported here to keep cold starts fast
+        from pypdf import PdfReader, PdfWriter
+        # A memory map is read as a file, so pages are only read from disk when needed
+        reader = PdfReader(doc_contents if isinstance(doc_contents, mmap.mmap) else io.BytesIO(doc_contents))
+
+        def write_pages(pages):
+            writer = PdfWriter()
+            for page in pages:
+                writer.add_page(page)
+            part = io.BytesIO()
+            writer.write(part)
+            return part.getvalue()
+
+        # Each page is measured as a PDF of its own. Resources shared between pages, like
+        # fonts, are counted for every page, so the parts come out smaller than planned.
+        page_ranges = []
+        start, size = 0, 0
+        for index, page in enumerate(reader.pages):
+            page_size = len(write_pages([page]))
+            if page_size > SIZE_LIMIT:
+                raise ValueError(f"page {index + 1} is larger than {SIZE_LIMIT / (1024 * 1024):.1f}MB on its own")
+            if index > start and (index - start >= DOCUMENT_CHUNK_PAGES or size + page_size > SIZE_LIMIT):
+                page_ranges.append((start, index))
+                start, size = index, 0
+            size += page_size
+        if start < len(reader.pages):
+            page_ranges.append((start, len(reader.pages)))
+
+        def pdf_parts():
+            for start, end in page_ranges:
+                yield write_pages(reader.pages[start:end])
+
+        return len(page_ranges), pdf_parts()
+
+    # Split text files at line breaks, which are never inside a multi-byte UTF-8 character.
+    # Without one, the split backs off to the start of a character: continuation bytes
+    # of UTF-8 start with the bits 10.
+    byte_ranges = []
+    start = 0
+    while start < len(doc_contents):
+        end = min(start + DOCUMENT_CHUNK_SIZE, len(doc_contents))
+        if end < len(doc_contents):
+            line_end = doc_contents.rfind(b'\n', start, end)
+            if line_end > start:
+                end = line_end + 1
+            else:
+                character_start = end
+                while character_start > start and doc_contents[character_start] & 0xC0 == 0x80:
+                    character_start -= 1
+                if character_start > start:
+                    end = character_start
+        byte_ranges.append((start, end))
+        start = end
+    return len(byte_ranges), (doc_contents[start:end] for start, end in byte_ranges)
+
+async def analyze_large_document(context, chat_id, doc_contents, file_type, file_name):
+    """Analyze a document too large to send inline, by summarizing its parts and merging the summaries.
+
+    Parts are built lazily and analyzed DOCUMENT_CHUNK_CONCURRENCY at a time, with progress
+    shown in the chat.
+    """
+    part_count, parts = await asyncio.to_thread(document_chunks, doc_contents, file_type)
+    print(f"Analyzing {file_name} in {part_count} parts")
+    progress_message = await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"This is a large document, analyzing it in {part_count} parts..."
+    )
+    summaries = [None] * part_count
+    usage = {'inputTokens': 0, 'outputTokens': 0, 'totalTokens': 0}
+    started = time.perf_counter()
+    last_progress = started
+    parts_lock = asyncio.Lock()
+    part_index = iter(range(part_count))
+
+    async def analyze_parts():
+        nonlocal last_progress
+        while True:
+            # Parts come from a generator, so only one worker can build the next part at a time
+            async with parts_lock:
+                index = next(part_index, None)
+                if index is None:
+                    return
+                part = await asyncio.to_thread(next, parts)
+            analysis = await analyze_document(
+                part, file_type, f"{file_name} part {index + 1}",
+                prompt=f"This is part {index + 1} of {part_count} of a document. Summarize the key content of this part, so it can be combined with the summaries of the other parts."
+            )
+            summaries[index] = analysis['text']
+            for key in usage:
+                usage[key] += analysis['usage'].get(key, 0)
+
+            done = sum(summary is not None for summary in summaries)
+            now = time.perf_counter()
+            if done < part_count and now - last_progress >= STREAM_EDIT_INTERVAL:
+                last_progress = now
+                await context.bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=progress_message.message_id,
+                    text=f"This is a large document, analyzed {done} of {part_count} parts..."
+                )
+
+    await asyncio.gather(*(analyze_parts() for _ in range(min(DOCUMENT_CHUNK_CONCURRENCY, part_count))))
+
+    await context.bot.edit_message_text(
+        chat_id=chat_id,
+        message_id=progress_message.message_id,
+        text=f"This is a large document, analyzed all {part_count} parts. Combining the results..."
+    )
+    combined = "\n\n".join(f"Summary of part {index + 1}:\n{summary}" for index, summary in enumerate(summaries))
+    response = await router.converse(
+        messages=[{
+            "role": "user",
+            "content": [{"text": f"These are summaries of the {part_count} parts of the document {sanitize_filename(file_name)}, in order. Please analyze the whole document based on them.\n\n{combined}"}]
+        }]
+    )
+    for key in usage:
+        usage[key] += response['usage'].get(key, 0)
+    return {
+        'text': ''.join(item['text'] for item in response['output']['message']['content'] if 'text' in item),
+        'latency_ms': round((time.perf_counter() - started) * 1000),
+        'usage': usage
+    }
+
+
+# Document analyses are cached by file_unique_id and by content hash, for the preferred model,
+# first in the warm process and then in the ChatHistory table
+document_cache = TTLCache(maxsize=128, ttl=DOCUMENT_CACHE_TTL)
+document_cache_stats = {'memory_hits': 0, 'table_hits': 0, 'misses': 0}
+
+def document_cache_item_key(key):
+    return {'chat_id': f'DOC#{MODEL_IDS[0]}#{key}', 'timestamp': 'ANALYSIS'}
+
+async def get_cached_analysis(key):
+    analysis = document_cache.get((MODEL_IDS[0], key))
+    if analysis is not None:
+        document_cache_stats['memory_hits'] += 1
+        record_metric('DocumentCacheHit', 1)
+        print(f"Document cache hit in memory: {key}")
+        return analysis
+    try:
+        response = await run_aws(table.get_item, Key=document_cache_item_key(key))
+    except Exception as e:
+        print(f"Error getting cached document analysis: {e}")
+        return None
+    if 'Item' not in response:
+        return None
+    analysis = json.loads(decode_text(response['Item'], 'content'))
+    document_cache.set((MODEL_IDS[0], key), analysis)
+    document_cache_stats['table_hits'] += 1
+    record_metric('DocumentCacheHit', 1)
+    print(f"Document cache hit in table: {key}")
+    return analysis
+
+async def save_cached_analysis(keys, analysis):
+    ttl = int(time.time() + DOCUMENT_CACHE_TTL)
+    # Stored as a JSON string, so the usage counts don't come back from DynamoDB as Decimals
+    content = json.dumps(analysis)
+    for key in keys:
+        document_cache.set((MODEL_IDS[0], key), analysis)
+        item = {
+            **document_cache_item_key(key),
+            'record_type': 'DOCUMENT_ANALYSIS',
+            'expireat': ttl
+        }
+        encode_text(item, 'content', content)
+        try:
+            await run_aws(table.put_item, Item=item)
+        except Exception as e:
+            print(f"Error saving cached document analysis: {e}")
+
+def format_document_cache_stats():
+    return (f"{document_cache_stats['memory_hits']} memory hits, "
+            f"{document_cache_stats['table_hits']} table hits, "
+            f"{document_cache_stats['misses']} misses")
+
+@asynccontextmanager
+async def downloaded_document(file, file_size):
+    """Download a telegram file, yielding its contents.
+
+    Files that are sent to Bedrock inline are downloaded into memory. Larger files, which are
+    analyzed in parts, are written to a private, anonymous temporary file (so concurrent
+    uploads never share a path) and yielded as a read-only memory map of it, so that only
+    the parts being analyzed are held in memory.
+    """
+    if file_size <= SIZE_LIMIT:
+        # Bedrock accepts the bytearray as is, so the contents are not copied again
+        yield await file.download_as_bytearray()
+        return
+    with tempfile.TemporaryFile(dir='/tmp') as spool:
+        await file.download_to_memory(out=spool)
+        spool.flush()
+        with mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+            yield contents
 
 async def debug_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -399,80 +1527,145 @@ async def thinking_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text="Failed to update thinking settings."
         )
 
-async def get_debug_status(chat_id):
+# All the settings for a chat are kept in a single item, cached in the warm process
+settings_cache = TTLCache(maxsize=1024, ttl=SETTINGS_CACHE_TTL)
+
+async def get_chat_settings(chat_id):
+    settings = settings_cache.get(str(chat_id))
+    if settings is not None:
+        record_metric('SettingsCacheHit', 1)
+        return settings
+    record_metric('SettingsCacheMiss', 1)
     try:
-        response = table.query(
-            IndexName='DebugSettingsIndex',
-            KeyConditionExpression='chat_id = :chat_id AND record_type = :type',
-            ExpressionAttributeValues={
-                ':chat_id': str(chat_id),
-                ':type': 'DEBUG_SETTINGS'
-            },
-            ScanIndexForward=False,  # Get most recent first
-            Limit=1  # We only need the most recent setting
+        response = await run_aws(
+            table.get_item,
+            Key={'chat_id': str(chat_id), 'timestamp': SETTINGS_KEY}
         )
-        items = response.get('Items', [])
-        print(f"Debug items: {items}")  # Add logging for debugging
-        return items[0].get('debug_enabled', False) if items else False
+        # Changes still in the write buffer are applied over the stored settings
+        settings = {**response.get('Item', {}), **write_buffer.changes(chat_id, SETTINGS_KEY)}
+        settings_cache.set(str(chat_id), settings)
+        return settings
     except Exception as e:
-        print(f"Error getting debug status: {e}")
-        return False
+        print(f"Error getting chat settings: {e}")
+        return {}
 
-async def save_debug_status(chat_id, status):
+async def save_chat_setting(chat_id, name, value):
     try:
         current_time = datetime.utcnow()
-        timestamp = current_time.isoformat()
         # Calculate TTL (current time + 1 hour) in epoch seconds
         ttl = int((current_time + timedelta(hours=1)).timestamp())
         
-        table.put_item(Item={
-            'chat_id': str(chat_id),
-            'timestamp': timestamp,
-            'record_type': 'DEBUG_SETTINGS',
-            'debug_enabled': status,
-            'expireat': ttl
-        })
+        settings = await get_chat_settings(chat_id)
+        # Only the changed attribute is written, so a setting changed by another process
+        # isn't overwritten with the settings cached in this one
+        changes = {'record_type': 'CHAT_SETTINGS', name: value, 'expireat': ttl}
+        write_buffer.update({'chat_id': str(chat_id), 'timestamp': SETTINGS_KEY}, changes)
+        settings_cache.set(str(chat_id), {**settings, **changes})
         return True
     except Exception as e:
-        print(f"Error saving debug status: {e}")
+        print(f"Error saving {name} setting: {e}")
         return False
 
-async def get_thinking_status(chat_id):
+# The rolling summary of older messages of each chat, cached in the warm process
+summary_cache = TTLCache(maxsize=1024, ttl=SETTINGS_CACHE_TTL)
+compacting_chats = set()
+
+async def get_chat_summary(chat_id):
+    summary = summary_cache.get(str(chat_id))
+    if summary is not None:
+        return summary
     try:
-        response = table.query(
-            IndexName='DebugSettingsIndex',
-            KeyConditionExpression='chat_id = :chat_id AND record_type = :type',
-            ExpressionAttributeValues={
-                ':chat_id': str(chat_id),
-                ':type': 'THINKING_SETTINGS'
-            },
-            ScanIndexForward=False,
-            Limit=1
+        response = await run_aws(
+            table.get_item,
+            Key={'chat_id': str(chat_id), 'timestamp': SUMMARY_KEY}
         )
-        items = response.get('Items', [])
-        print(f"Thinking items: {items}")  # Add logging for thinking
-        return items[0].get('thinking_enabled', False) if items else False
+        summary = response.get('Item', {})
+        summary_cache.set(str(chat_id), summary)
+        return summary
     except Exception as e:
-        print(f"Error getting thinking status: {e}")
-        return False
+        print(f"Error getting chat summary: {e}")
+        return {}
 
-async def save_thinking_status(chat_id, status):
+async def compact_history(chat_id):
+    """Fold the oldest chat messages into the chat summary.
+
+    Runs once a turn finds the messages since the last summary over COMPACT_THRESHOLD_CHARS
+    or HISTORY_MAX_TURNS, keeping the most recent COMPACT_KEEP_TURNS messages as they are,
+    so the context sent with each message stays bounded. Only then is the whole history
+    since the summary read. Skipped with less than COMPACT_MIN_TIME_MS left.
+    """
+    if chat_id in compacting_chats:
+        return
+    remaining_ms = request_context.get().remaining_ms() if request_context.get() else None
+    if remaining_ms is not None and remaining_ms < COMPACT_MIN_TIME_MS:
+        # The next turn finds the history over the limits again
+        print(f"Not enough time left to compact the chat history: {remaining_ms:.0f} ms")
+        record_metric('CompactionDeferred', 1)
+        return
+    compacting_chats.add(chat_id)
     try:
-        current_time = datetime.utcnow()
-        timestamp = current_time.isoformat()
-        ttl = int((current_time + timedelta(hours=1)).timestamp())
-        
-        table.put_item(Item={
+        summary = await get_chat_summary(chat_id)
+        history = await get_chat_history(chat_id, max_turns=COMPACT_MAX_TURNS, max_chars=float('inf'), after=summary.get('covers_until'))
+
+        # History is newest first. The kept messages must still start with a user message.
+        kept, folded = history[:COMPACT_KEEP_TURNS], history[COMPACT_KEEP_TURNS:]
+        while kept and kept[-1]['role'] != 'user':
+            folded.insert(0, kept.pop())
+        if not folded:
+            return
+
+        transcript = "\n\n".join(f"{msg['role']}: {msg['content']}" for msg in reversed(folded))
+        previous = f"This is the summary of the conversation so far:\n{summary['content']}\n\n" if summary else ""
+        response = await router.converse(
+            messages=[{
+                "role": "user",
+                "content": [{"text": f"{previous}These are the next messages of the conversation:\n\n{transcript}\n\nWrite an updated, concise summary of the whole conversation, keeping the facts, names, decisions and open questions that later messages may refer to."}]
+            }]
+        )
+        summary = {
             'chat_id': str(chat_id),
-            'timestamp': timestamp,
-            'record_type': 'THINKING_SETTINGS',
-            'thinking_enabled': status,
-            'expireat': ttl
-        })
-        return True
+            'timestamp': SUMMARY_KEY,
+            'record_type': 'CHAT_SUMMARY',
+            'content': ''.join(item['text'] for item in response['output']['message']['content'] if 'text' in item),
+            'covers_until': folded[0]['timestamp'],
+            'expireat': int((datetime.utcnow() + timedelta(hours=1)).timestamp())
+        }
+        await run_aws(table.put_item, Item=summary)
+        summary_cache.set(str(chat_id), summary)
+        print(f"Folded {len(folded)} messages into the chat summary")
     except Exception as e:
-        print(f"Error saving thinking status: {e}")
-        return False
+        print(f"Error compacting chat history: {e}")
+    finally:
+        compacting_chats.discard(chat_id)
+
+
+# Tasks that run after the reply has been sent. They are awaited before the webhook
+# responds, as Lambda freezes the environment once the response has been sent.
+background_tasks = set()
+
+def run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def drain_background_tasks():
+    while background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+
+
+async def get_debug_status(chat_id):
+    settings = await get_chat_settings(chat_id)
+    return settings.get('debug_enabled', False)
+
+async def save_debug_status(chat_id, status):
+    return await save_chat_setting(chat_id, 'debug_enabled', status)
+
+async def get_thinking_status(chat_id):
+    settings = await get_chat_settings(chat_id)
+    return settings.get('thinking_enabled', False)
+
+async def save_thinking_status(chat_id, status):
+    return await save_chat_setting(chat_id, 'thinking_enabled', status)
 
 
 
@@ -481,53 +1674,25 @@ async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     try:
-        # First, get all items for this chat_id where record_type is CHAT_MESSAGE
-        response = table.query(
-            KeyConditionExpression='chat_id = :chat_id',
-            FilterExpression='record_type = :type',
-            ExpressionAttributeValues={
-                ':chat_id': str(chat_id),
-                ':type': 'CHAT_MESSAGE'
-            }
-        )
-        
-        items = response.get('Items', [])
+        # Forget the summary of older messages too
+        await run_aws(table.delete_item, Key={'chat_id': str(chat_id), 'timestamp': SUMMARY_KEY})
+        summary_cache.pop(str(chat_id))
+
+        deleted_count, failed_count = await delete_chat_messages(chat_id)
         
-        if not items:
+        if not deleted_count and not failed_count:
             await context.bot.send_message(
                 chat_id=chat_id,
                 text="No chat history found to clear."
             )
             return
-        
-        # DynamoDB batch_write_item can only handle 25 items at a time
-        batch_size = 25
-        deleted_count = 0
-        
-        for i in range(0, len(items), batch_size):
-            batch_items = items[i:i + batch_size]
-            
-            # Prepare batch delete request
-            delete_requests = [
-                {
-                    'DeleteRequest': {
-                        'Key': {
-                            'chat_id': item['chat_id'],
-                            'timestamp': item['timestamp']
-                        }
-                    }
-                }
-                for item in batch_items
-            ]
-            
-            # Execute batch delete
-            dynamodb.batch_write_item(
-                RequestItems={
-                    CHAT_HISTORY_TABLE: delete_requests
-                }
+
+        if failed_count:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"Cleared {deleted_count} messages from your chat history, but {failed_count} could not be deleted. Please send /clear again."
             )
-            
-            deleted_count += len(batch_items)
+            return
         
         # Send confirmation message
         await context.bot.send_message(
@@ -548,14 +1713,191 @@ async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text="Sorry, I encountered an error while trying to clear your chat history."
         )
 
-async def get_current_datetime():
-    """Get current date and time in a formatted string"""
+async def delete_chat_messages(chat_id):
+    """Delete all the messages of a chat, returning the number deleted and the number that failed.
+
+    The message keys are read page by page with a keys-only query, and each page is
+    deleted in batches while the next one is read.
+    """
+    # Buffered messages are written first, so that none are written after the clear
+    await write_buffer.flush()
+    semaphore = asyncio.Semaphore(BATCH_WRITE_CONCURRENCY)
+    batches = []
+    count = 0
+    for prefix in [MESSAGE_KEY_PREFIX, LEGACY_MESSAGE_KEY_PREFIX]:
+        query = {
+            'KeyConditionExpression': 'chat_id = :chat_id AND begins_with(#ts, :prefix)',
+            'ProjectionExpression': 'chat_id, #ts',
+            'ExpressionAttributeNames': {'#ts': 'timestamp'},
+            'ExpressionAttributeValues': {
+                ':chat_id': str(chat_id),
+                ':prefix': prefix
+            }
+        }
+        while True:
+            response = await run_aws(table.query, **query)
+            requests = [
+                {'DeleteRequest': {'Key': {'chat_id': item['chat_id'], 'timestamp': item['timestamp']}}}
+                for item in response.get('Items', [])
+            ]
+            count += len(requests)
+            for i in range(0, len(requests), BATCH_WRITE_SIZE):
+                batches.append(asyncio.create_task(write_batch(requests[i:i + BATCH_WRITE_SIZE], semaphore)))
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    failed = sum(len(unprocessed) for unprocessed in await asyncio.gather(*batches))
+    return count - failed, failed
+
+async def write_batch(requests, semaphore):
+    """Send up to 25 write requests with BatchWriteItem, retrying the unprocessed ones with
+    exponential backoff. Returns the requests that could not be written."""
+    async with semaphore:
+        for attempt in range(BATCH_WRITE_ATTEMPTS):
+            if attempt:
+                # Exponential backoff with full jitter, capped at 2 seconds
+                await asyncio.sleep(random.uniform(0, min(2.0, 0.05 * 2 ** attempt)))
+            try:
+                response = await run_aws(dynamodb.batch_write_item, RequestItems={CHAT_HISTORY_TABLE: requests})
+            except Exception as e:
+                # Throttling errors have already been retried by botocore
+                print(f"Error writing a batch of {len(requests)} items: {e}")
+                break
+            requests = response.get('UnprocessedItems', {}).get(CHAT_HISTORY_TABLE, [])
+            if not requests:
+                break
+    if requests:
+        print(f"Failed to write {len(requests)} items")
+    return requests
+
+
+class WriteBuffer:
+    """Write-behind buffer of table items, written with BatchWriteItem.
+
+    Items are kept by key, so a later write of the same item replaces the buffered one.
+    Changes to some attributes of an item are buffered apart, and written with UpdateItem,
+    which keeps the other attributes. The buffer is flushed once it holds max_items or
+    after max_delay seconds, and has to be flushed before the webhook responds, as Lambda
+    freezes the environment then. Buffered items and changes are readable until they have
+    been written.
+    """
+
+    def __init__(self, max_items, max_delay):
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.items = {}
+        self.in_flight = {}
+        self.updates = {}
+        self.updates_in_flight = {}
+        self.writes = set()
+        self._timer = None
+
+    def put(self, item):
+        self.items[(item['chat_id'], item['timestamp'])] = item
+        if len(self.items) >= self.max_items:
+            run_in_background(self.flush())
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, lambda: run_in_background(self.flush()))
+
+    def update(self, key, attributes):
+        """Buffer a change to some attributes of the item with the key"""
+        key = (key['chat_id'], key['timestamp'])
+        self.updates[key] = {**self.updates.get(key, {}), **attributes}
+        self._schedule_flush()
+
+    def changes(self, chat_id, timestamp):
+        """Attribute changes of an item that haven't been written yet"""
+        key = (str(chat_id), timestamp)
+        return {**self.updates_in_flight.get(key, {}), **self.updates.get(key, {})}
+
+    def pending(self, chat_id, prefix):
+        """Buffered items of a chat with a sort key prefix, newest first"""
+        items = {**self.in_flight, **self.items}
+        return sorted(
+            (item for (item_chat_id, timestamp), item in items.items() if item_chat_id == str(chat_id) and timestamp.startswith(prefix)),
+            key=lambda item: item['timestamp'],
+            reverse=True
+        )
+
+    async def flush(self):
+        """Write the buffered items and changes, and wait for the writes already in flight"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.items or self.updates:
+            items, self.items = self.items, {}
+            updates, self.updates = self.updates, {}
+            self.in_flight.update(items)
+            self.updates_in_flight.update(updates)
+            write = asyncio.ensure_future(self._write(items, updates))
+            self.writes.add(write)
+            write.add_done_callback(self.writes.discard)
+        if self.writes:
+            # Unlike gather, wait doesn't cancel the writes if the caller is cancelled
+            await asyncio.wait(set(self.writes))
+
+    async def _write(self, items, updates):
+        try:
+            with span('Persist'):
+                requests = [{'PutRequest': {'Item': item}} for item in items.values()]
+                semaphore = asyncio.Semaphore(BATCH_WRITE_CONCURRENCY)
+                unprocessed, updated = await asyncio.gather(
+                    asyncio.gather(*(
+                        write_batch(requests[i:i + BATCH_WRITE_SIZE], semaphore)
+                        for i in range(0, len(requests), BATCH_WRITE_SIZE)
+                    )),
+                    asyncio.gather(*(self._update(key, attributes) for key, attributes in updates.items()))
+                )
+        finally:
+            for key, item in items.items():
+                if self.in_flight.get(key) is item:
+                    del self.in_flight[key]
+            for key, attributes in updates.items():
+                if self.updates_in_flight.get(key) is attributes:
+                    del self.updates_in_flight[key]
+        # Items that couldn't be written go back in the buffer, unless they have been replaced
+        for request in (request for requests in unprocessed for request in requests):
+            item = request['PutRequest']['Item']
+            self.items.setdefault((item['chat_id'], item['timestamp']), item)
+        for (key, attributes), written in zip(updates.items(), updated):
+            if not written:
+                self.updates[key] = {**attributes, **self.updates.get(key, {})}
+        if self.items or self.updates:
+            self._schedule_flush()
+
+    async def _update(self, key, attributes):
+        """Set the attributes of an item with UpdateItem, returning whether it was written"""
+        names = list(attributes)
+        try:
+            await run_aws(
+                table.update_item,
+                Key={'chat_id': key[0], 'timestamp': key[1]},
+                UpdateExpression='SET ' + ', '.join(f'#a{i} = :v{i}' for i in range(len(names))),
+                ExpressionAttributeNames={f'#a{i}': name for i, name in enumerate(names)},
+                ExpressionAttributeValues={f':v{i}': attributes[name] for i, name in enumerate(names)}
+            )
+            return True
+        except Exception as e:
+            print(f"Error updating item {key}: {e}")
+            return False
+
+write_buffer = WriteBuffer(WRITE_BUFFER_MAX_ITEMS, WRITE_BUFFER_MAX_DELAY)
+
+async def get_current_datetime(bucket=None):
+    """Get current date and time in a formatted string, rounded down to bucket seconds if given"""
     current = datetime.utcnow()
+    if bucket:
+        current = datetime.utcfromtimestamp(int(time.time()) // bucket * bucket)
     return current.strftime("%Y-%m-%d %H:%M:%S UTC")
 
 
 
-async def main(event, context):
+def register_handlers(application):
     # Register command handlers
     application.add_handler(CommandHandler('status', status_command))
 
@@ -572,6 +1914,9 @@ async def main(event, context):
     # Add the clear chat history command handler
     application.add_handler(CommandHandler('clear', clear_command))
     
+    # PTB catches the errors of the handlers, this hands them back to process_update_body
+    application.add_error_handler(error_handler)
+
     # Add these handlers to catch different document types
     application.add_handler(MessageHandler(
         filters.Document.PDF |
@@ -587,13 +1932,112 @@ async def main(event, context):
         filters.Document.MimeType("text/plain"),
         document_handler
     ))
-    
 
-    try:    
-        await application.initialize()
-        await application.process_update(
-            Update.de_json(json.loads(event["body"]), application.bot)
+
+# Telegram update_ids claimed by this process, checked before the shared marker in DynamoDB
+recent_update_ids = TTLCache(maxsize=10000, ttl=UPDATE_DEDUP_TTL)
+
+async def claim_update(update_id):
+    """Claim an update for processing, returning False if it has already been claimed.
+
+    Telegram redelivers updates when the webhook is slow or fails, so each update_id is
+    claimed with a conditional write of a marker item that expires after UPDATE_DEDUP_TTL.
+    """
+    if recent_update_ids.get(update_id):
+        return False
+    recent_update_ids.set(update_id, True)
+    try:
+        await run_aws(
+            table.put_item,
+            Item={
+                'chat_id': f'UPDATE#{update_id}',
+                'timestamp': 'UPDATE',
+                'record_type': 'UPDATE_MARKER',
+                'expireat': int(time.time() + UPDATE_DEDUP_TTL)
+            },
+            ConditionExpression='attribute_not_exists(chat_id)'
         )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        # Rather process a possible duplicate than drop the update
+        print(f"Error claiming update {update_id}: {e}")
+    except Exception as e:
+        # Transport errors of botocore aren't ClientErrors, and are handled the same way
+        print(f"Error claiming update {update_id}: {e}")
+    return True
+
+async def release_update(update_id):
+    """Release the claim on an update that failed, so that a redelivery is processed"""
+    recent_update_ids.pop(update_id)
+    try:
+        await run_aws(table.delete_item, Key={'chat_id': f'UPDATE#{update_id}', 'timestamp': 'UPDATE'})
+    except Exception as e:
+        print(f"Error releasing update {update_id}: {e}")
+
+# The error of the update being processed, if a handler failed
+update_error = contextvars.ContextVar('update_error', default=None)
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Record the error of a handler, so the update is reported as failed and can be retried"""
+    print(f"Error handling update: {''.join(traceback.format_exception(context.error))}")
+    update_error.set(context.error)
+
+def needs_more_time(update):
+    """Whether the update is a large document that can't be analyzed before the deadline"""
+    message = update.effective_message
+    document = message.document if message else None
+    if document is None or document.mime_type not in CHUNKED_DOCUMENT_TYPES:
+        return False
+    if not SIZE_LIMIT < (document.file_size or 0) <= DOCUMENT_MAX_SIZE:
+        return False
+    remaining_ms = request_context.get().remaining_ms() if request_context.get() else None
+    return remaining_ms is not None and remaining_ms < LARGE_DOCUMENT_MIN_TIME_MS
+
+def update_type(update):
+    """Kind of update, the dimension of its metrics"""
+    message = update.effective_message
+    if message is None:
+        return 'other'
+    if message.document:
+        return 'document'
+    if message.text and message.text.startswith('/'):
+        return 'command'
+    return 'text' if message.text else 'other'
+
+async def process_update_body(body):
+    with metrics_scope() as metrics, span('Update'):
+        update = Update.de_json(json.loads(body), application.bot)
+        metrics.update_type = update_type(update)
+        metrics.properties['update_id'] = update.update_id
+        if document_queue and needs_more_time(update):
+            # Claimed by the function consuming the document queue
+            await document_queue.put(body)
+            print(f"Handed off update {update.update_id} to the document queue")
+            record_metric('DocumentHandoff', 1)
+            return
+        if not await claim_update(update.update_id):
+            print(f"Skipping duplicate update {update.update_id}")
+            record_metric('DuplicateUpdate', 1)
+            return
+        # The error handler runs in the task of the update, so it sets the error seen here
+        token = update_error.set(None)
+        try:
+            await application.process_update(update)
+            if update_error.get() is not None:
+                raise update_error.get()
+        except Exception:
+            record_metric('UpdateError', 1)
+            await release_update(update.update_id)
+            raise
+        finally:
+            update_error.reset(token)
+
+async def main(event):
+    try:
+        await process_update_body(event["body"])
+        await drain_background_tasks()
+        await write_buffer.flush()
     
         return {
             'statusCode': 200,
@@ -607,11 +2051,111 @@ async def main(event, context):
             'body': 'Failure'
         }
 
+
+class InProcessUpdateQueue:
+    """Queue updates in memory and process them with a bounded pool of asyncio workers.
+
+    Meant for long running processes and local runs: on Lambda the environment is frozen
+    once the webhook response is sent, so queued work only resumes on the next invocation.
+    """
+
+    def __init__(self, handler, workers, maxsize=1000):
+        self.handler = handler
+        self.workers = workers
+        self._queue = asyncio.Queue(maxsize)
+        self._tasks = []
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        # Finish the queued updates before stopping the workers
+        await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def put(self, body):
+        # Raises asyncio.QueueFull when the workers can't keep up
+        self._queue.put_nowait(body)
+
+    async def _work(self):
+        while True:
+            body = await self._queue.get()
+            try:
+                await self.handler(body)
+            except Exception as e:
+                print(f"Error processing queued update: {e}")
+            finally:
+                self._queue.task_done()
+
+
+class SQSUpdateQueue:
+    """Queue updates durably in SQS.
+
+    SQS delivers the messages back to this function, and the Lambda Web Adapter passes
+    them through to the /events endpoint.
+    """
+
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.sqs = LazyClient(self.create_sqs_client)
+
+    @staticmethod
+    def create_sqs_client():
+        import boto3
+        return boto3.client('sqs', config=aws_client_config())
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def put(self, body):
+        await run_aws(self.sqs.send_message, QueueUrl=self.queue_url, MessageBody=body)
+
+
+if UPDATE_QUEUE_URL:
+    update_queue = SQSUpdateQueue(UPDATE_QUEUE_URL)
+else:
+    update_queue = InProcessUpdateQueue(process_update_body, UPDATE_WORKERS)
+document_queue = SQSUpdateQueue(DOCUMENT_QUEUE_URL) if DOCUMENT_QUEUE_URL else None
+
+async def queued_updates(request: Request):
+    # SQS batches of queued updates, passed through by the Lambda Web Adapter
+    request_context.set(RequestContext.from_headers(request.headers))
+    event = await request.json()
+    records = event.get('Records', [])
+    semaphore = asyncio.Semaphore(UPDATE_WORKERS)
+
+    async def process_record(record):
+        async with semaphore:
+            try:
+                await process_update_body(record['body'])
+                return None
+            except Exception as e:
+                print(f"Error processing queued update {record['messageId']}: {e}")
+                return {"itemIdentifier": record['messageId']}
+
+    failures = await asyncio.gather(*(process_record(record) for record in records))
+    await drain_background_tasks()
+    await write_buffer.flush()
+    # Only the failed updates are retried by SQS
+    return {"batchItemFailures": [failure for failure in failures if failure]}
+
+if RUNNING_ON_LAMBDA:
+    bot.post("/events")(queued_updates)
+
 @bot.post("/bot")
 async def webhook(request: Request):
-    global start_time, lambda_context
-    start_time = time.perf_counter()
-    
+    # Each request is handled in its own task, so its context isn't seen by other requests
+    request_context.set(RequestContext.from_headers(request.headers))
+    # In sync mode, the metrics of the update are emitted along with the webhook time
+    with metrics_scope(), span('Webhook'):
+        return await handle_webhook(request)
+
+async def handle_webhook(request: Request):
     # Get headers
     headers = dict(request.headers)
     
@@ -622,20 +2166,26 @@ async def webhook(request: Request):
 
     # Get request body
     body = await request.body()
+
+    if WEBHOOK_MODE == 'async':
+        # Acknowledge the update straight away, and leave it to the update workers
+        try:
+            update_id = json.loads(body)['update_id']
+            await update_queue.put(body.decode('utf-8'))
+        except (ValueError, KeyError, TypeError):
+            print("Bad Request - not a Telegram update")
+            return JSONResponse(status_code=400, content={"error": "Bad Request"})
+        except asyncio.QueueFull:
+            # Telegram retries the update later
+            print("Update queue is full")
+            return JSONResponse(status_code=503, content={"error": "Busy"})
+        print(f"Queued update {update_id}")
+        return JSONResponse(status_code=200, content={"message": "Queued"})
     
     # Create mock event for compatibility with existing main function
     event = {"body": body.decode('utf-8'), "headers": headers}
     
-    # Create mock context
-    class MockContext:
-        def __init__(self):
-            self.function_version = "$LATEST"
-        def get_remaining_time_in_millis(self):
-            return 30000
-    
-    lambda_context = MockContext()
-    
-    result = await main(event, lambda_context)
+    result = await main(event)
     
     return JSONResponse(status_code=result.get('statusCode', 200), content={"message": result.get('body', 'Success')})
 
@@ -0,0 +1,83 @@
+"""Run the bot with getUpdates long polling instead of the webhook, for local and self-hosted runs.
+
+    python poll.py
+
+The handlers, storage and model layers are the ones of the webhook in bot.py, with up to
+POLL_WORKERS updates processed at the same time. Telegram only delivers updates by
+polling while no webhook is set, so starting the poller removes the webhook of the bot.
+Set TELEGRAM_BASE_URL to poll a local Bot API server, or a fake one.
+"""
+import asyncio
+import os
+import signal
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import bot
+
+# Updates processed at the same time. Turns of the same chat still run one at a time.
+POLL_WORKERS = int(os.environ.get('POLL_WORKERS', '32'))
+# Seconds each getUpdates call waits for new updates
+POLL_TIMEOUT = int(os.environ.get('POLL_TIMEOUT', '30'))
+
+
+class UpdateProcessor(BaseUpdateProcessor):
+    """Process polled updates concurrently, skipping duplicates and collecting the metrics
+    of each update, as the webhook does"""
+
+    async def do_process_update(self, update, coroutine):
+        if not isinstance(update, Update):
+            await coroutine
+            return
+        with bot.metrics_scope() as metrics, bot.span('Update'):
+            metrics.update_type = bot.update_type(update)
+            metrics.properties['update_id'] = update.update_id
+            # Updates are delivered again if the poller stops before confirming them
+            if not await bot.claim_update(update.update_id):
+                print(f"Skipping duplicate update {update.update_id}")
+                bot.record_metric('DuplicateUpdate', 1)
+                coroutine.close()
+                return
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+async def run(stop):
+    """Poll for updates until the stop event is set"""
+    await bot.start_bot(concurrent_updates=UpdateProcessor(POLL_WORKERS))
+    bot.mark_init('ready')
+    print(f"Init timings (ms): {bot.init_timings}")
+    application = bot.application
+    try:
+        await application.start()
+        await application.updater.start_polling(timeout=POLL_TIMEOUT, allowed_updates=Update.ALL_TYPES)
+        print(f"Polling for updates with {POLL_WORKERS} workers")
+        await stop.wait()
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            # Waits for the updates being processed
+            await application.stop()
+        await bot.stop_bot()
+
+
+def main():
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+        await run(stop)
+
+    asyncio.run(serve())
+
+
+if __name__ == '__main__':
+    main()
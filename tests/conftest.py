@@ -0,0 +1,74 @@
+"""Shared setup of the tests.
+
+The bot is imported with a local configuration, and each test gets it with its AWS clients
+and the Telegram Bot API replaced by the stand-ins in bench/fakes.py.
+"""
+import asyncio
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+sys.path.insert(0, os.path.join(ROOT, 'src', 'Function'))
+
+SECRET_TOKEN = 'test-secret'
+
+# The bot reads its configuration at import time
+os.environ.setdefault('CHATHISTORY_TABLE_NAME', 'ChatHistory')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ['TELEGRAM_BOT_TOKEN'] = '123456:TEST'
+os.environ['TELEGRAM_API_SECRET_TOKEN'] = SECRET_TOKEN
+os.environ['STREAM_RESPONSES'] = 'false'
+os.environ['METRICS_ENABLED'] = 'false'
+os.environ['LOG_SAMPLE_RATE'] = '0'
+os.environ.pop('UPDATE_QUEUE_URL', None)
+# As on Lambda, so that the /events route of the update queue is registered
+os.environ['AWS_LAMBDA_FUNCTION_NAME'] = 'telegram-bot-test'
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    """The bot module wired to fresh fakes, with its per-process state reset"""
+    import bot
+    from fakes import FakeBedrock, FakeDynamoDB, FakeTable, FakeTelegramRequest
+    from telegram.ext import ApplicationBuilder
+
+    telegram = FakeTelegramRequest(latency=0)
+    table = FakeTable(bot.CHAT_HISTORY_TABLE, latency=0)
+    bedrock = FakeBedrock(latency=0, token_latency=0)
+    monkeypatch.setattr(bot, 'bedrock', bedrock)
+    monkeypatch.setattr(bot, 'dynamodb', FakeDynamoDB(table))
+    monkeypatch.setattr(bot, 'table', table)
+    monkeypatch.setattr(bot, 'build_application', lambda concurrent_updates=False: (
+        ApplicationBuilder().token(bot.TelegramBotToken).concurrent_updates(concurrent_updates)
+        .request(telegram).get_updates_request(telegram).build()
+    ))
+
+    # Each test runs in its own event loop, and stopping the bot shuts the executor down
+    monkeypatch.setattr(bot, 'aws_executor', ThreadPoolExecutor(max_workers=bot.AWS_IO_WORKERS))
+    monkeypatch.setattr(bot, 'model_slots', asyncio.Semaphore(bot.BEDROCK_MAX_IN_FLIGHT))
+    monkeypatch.setattr(bot, 'write_buffer', bot.WriteBuffer(bot.WRITE_BUFFER_MAX_ITEMS, bot.WRITE_BUFFER_MAX_DELAY))
+    monkeypatch.setattr(bot, 'update_queue', bot.InProcessUpdateQueue(bot.process_update_body, bot.UPDATE_WORKERS))
+    for name in ('recent_update_ids', 'settings_cache', 'summary_cache', 'document_cache',
+                 'response_cache', 'chats_without_legacy_messages'):
+        cache = getattr(bot, name)
+        monkeypatch.setattr(bot, name, bot.TTLCache(cache.maxsize, cache.ttl))
+
+    @asynccontextmanager
+    async def serve():
+        """Run the app, yielding an HTTP client for it"""
+        import httpx
+        async with bot.lifespan(bot.bot):
+            transport = httpx.ASGITransport(app=bot.bot)
+            async with httpx.AsyncClient(transport=transport, base_url='http://test', timeout=None) as client:
+                yield client
+
+    async def send(client, update):
+        return await client.post('/bot', json=update, headers={'x-telegram-bot-api-secret-token': SECRET_TOKEN})
+
+    return SimpleNamespace(bot=bot, telegram=telegram, table=table, bedrock=bedrock, serve=serve, send=send)
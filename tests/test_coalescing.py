@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+from fakes import text_update
+
+
+@pytest.fixture
+def coalescing(fake, monkeypatch):
+    monkeypatch.setattr(fake.bot, 'COALESCE_MESSAGES', True)
+    monkeypatch.setattr(fake.bot, 'pending_messages', {})
+    return fake
+
+
+def test_coalesced_messages_fail_with_their_turn(coalescing):
+    """Every update answered by a failed turn is reported as failed, so none of the messages is lost"""
+    fake = coalescing
+
+    async def run():
+        async with fake.serve() as client:
+            # An earlier turn of the chat is running, so the next messages wait for it together
+            async with fake.bot.chat_turn(101):
+                sends = [asyncio.create_task(fake.send(client, text_update(update_id, 101, f'part {update_id}')))
+                         for update_id in (1, 2, 3)]
+                await asyncio.sleep(0.1)
+                fake.bedrock.throttle_rate = 1.0
+            return await asyncio.gather(*sends)
+
+    responses = asyncio.run(run())
+    assert [response.status_code for response in responses] == [500, 500, 500]
+    # One turn answered all three
+    assert fake.bedrock.stats.counts['Converse'] == 1
+
+
+def test_coalesced_messages_are_answered_in_one_turn(coalescing):
+    fake = coalescing
+
+    async def run():
+        async with fake.serve() as client:
+            async with fake.bot.chat_turn(101):
+                sends = [asyncio.create_task(fake.send(client, text_update(update_id, 101, f'part {update_id}')))
+                         for update_id in (1, 2)]
+                await asyncio.sleep(0.1)
+            return await asyncio.gather(*sends)
+
+    assert [response.status_code for response in asyncio.run(run())] == [200, 200]
+    assert fake.bedrock.stats.counts['Converse'] == 1
+
+
+def test_cancelled_turn_doesnt_swallow_later_messages(coalescing):
+    fake = coalescing
+
+    async def run():
+        async with fake.serve() as client:
+            async with fake.bot.chat_turn(101):
+                waiting = asyncio.create_task(fake.send(client, text_update(1, 101, 'first')))
+                await asyncio.sleep(0.1)
+                waiting.cancel()
+                await asyncio.gather(waiting, return_exceptions=True)
+            return await fake.send(client, text_update(2, 101, 'second'))
+
+    assert asyncio.run(run()).status_code == 200
+    assert not fake.bot.pending_messages
+    assert fake.bedrock.stats.counts['Converse'] == 1
@@ -0,0 +1,27 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from fakes import text_update
+
+
+@pytest.mark.parametrize('seconds_left, model_calls', [(120, 2), (30, 1)])
+def test_compaction_only_runs_with_time_left(fake, monkeypatch, seconds_left, model_calls):
+    """The summary call is skipped when it could run the invocation past its deadline"""
+    monkeypatch.setattr(fake.bot, 'COMPACT_THRESHOLD_CHARS', 10)
+    monkeypatch.setattr(fake.bot, 'COMPACT_KEEP_TURNS', 0)
+    monkeypatch.setattr(fake.bot, 'COMPACT_MIN_TIME_MS', 60000)
+    context = json.dumps({'deadline': time.time() * 1000 + seconds_left * 1000})
+
+    async def run():
+        async with fake.serve() as client:
+            return await client.post('/bot', json=text_update(1, 101, 'hello'), headers={
+                'x-telegram-bot-api-secret-token': 'test-secret', 'x-amzn-lambda-context': context
+            })
+
+    assert asyncio.run(run()).status_code == 200
+    # The reply, and the summary call if there was time for it
+    assert fake.bedrock.stats.counts['Converse'] == model_calls
+    assert (('101', fake.bot.SUMMARY_KEY) in fake.table.items) == (model_calls == 2)
@@ -0,0 +1,24 @@
+import asyncio
+import time
+
+from fakes import text_update
+
+
+def test_model_calls_of_two_chats_overlap(fake):
+    """boto3 calls run on the AWS I/O pool, so a slow generation doesn't hold up another chat"""
+    fake.bedrock.latency = 0.5
+
+    async def run():
+        async with fake.serve() as client:
+            started = time.perf_counter()
+            responses = await asyncio.gather(
+                fake.send(client, text_update(1, 101, 'hello from the first chat')),
+                fake.send(client, text_update(2, 102, 'hello from the second chat'))
+            )
+            return time.perf_counter() - started, responses
+
+    elapsed, responses = asyncio.run(run())
+    assert [response.status_code for response in responses] == [200, 200]
+    assert fake.bedrock.stats.counts['Converse'] == 2
+    # Serialized, the two turns would take at least two model latencies
+    assert elapsed < 0.8, f"two turns took {elapsed:.2f} s"
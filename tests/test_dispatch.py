@@ -0,0 +1,29 @@
+import asyncio
+import statistics
+import time
+
+from fakes import text_update
+
+
+def test_dispatch_cost_stays_flat_on_a_warm_process(fake):
+    """Handlers are registered once, so the thousandth update is dispatched as fast as the first"""
+    updates = 1000
+
+    async def run():
+        timings = []
+        async with fake.serve() as client:
+            application = fake.bot.application
+            handlers = len(application.handlers[0])
+            for update_id in range(1, updates + 1):
+                started = time.perf_counter()
+                response = await fake.send(client, text_update(update_id, 100 + update_id % 10, '/start'))
+                timings.append(time.perf_counter() - started)
+                assert response.status_code == 200
+            assert fake.bot.application is application
+            assert len(application.handlers[0]) == handlers
+        return timings
+
+    timings = asyncio.run(run())
+    assert fake.telegram.stats.counts['sendMessage'] == updates
+    first, last = statistics.median(timings[:100]), statistics.median(timings[-100:])
+    assert last < first * 2 + 0.002, f"dispatch took {first * 1000:.2f} ms at first and {last * 1000:.2f} ms at the end"
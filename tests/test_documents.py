@@ -0,0 +1,151 @@
+import asyncio
+import io
+import random
+import re
+
+from fakes import FakeBedrock, document_update
+
+
+class EchoBedrock(FakeBedrock):
+    """Answers with the marker found in the document or text it was sent"""
+
+    def converse(self, **request):
+        response = super().converse(**request)
+        block = request['messages'][0]['content'][-1]
+        data = bytes(block['document']['source']['bytes']) if 'document' in block else block['text'].encode()
+        marker = re.search(rb'marker-\d+', data).group().decode()
+        response['output']['message']['content'] = [{'text': f'Analysis of {marker}'}]
+        return response
+
+
+def test_parallel_uploads_get_their_own_analysis(fake, monkeypatch):
+    """Concurrent uploads, small ones kept in memory and large ones spooled to disk, are not mixed up"""
+    bedrock = EchoBedrock(latency=0.05, token_latency=0)
+    monkeypatch.setattr(fake.bot, 'bedrock', bedrock)
+    # Documents over 64KB are spooled and analyzed in parts of up to 16KB
+    monkeypatch.setattr(fake.bot, 'SIZE_LIMIT', 64 * 1024)
+    monkeypatch.setattr(fake.bot, 'DOCUMENT_CHUNK_SIZE', 16 * 1024)
+    monkeypatch.setattr(fake.bot, 'WEBHOOK_MODE', 'async')
+    chats = range(101, 109)
+    for chat_id in chats:
+        lines = 200 if chat_id % 2 else 8000
+        fake.telegram.files[f'file{chat_id}'] = f'Line of the document with marker-{chat_id}\n'.encode() * lines
+
+    async def run():
+        async with fake.serve() as client:
+            return await asyncio.gather(*(
+                fake.send(client, document_update(chat_id, chat_id, f'file{chat_id}', len(fake.telegram.files[f'file{chat_id}'])))
+                for chat_id in chats
+            ))
+
+    # The queued updates are processed by the update workers before the app stops
+    assert [response.status_code for response in asyncio.run(run())] == [200] * len(chats)
+    replies = {}
+    for chat_id, text in fake.telegram.messages.values():
+        if text.startswith('Analysis of'):
+            replies.setdefault(chat_id, []).append(text)
+    assert replies == {chat_id: [f'Analysis of marker-{chat_id}'] for chat_id in chats}
+    # The large documents were analyzed in parts
+    assert bedrock.stats.counts['Converse'] > len(chats)
+
+
+def pdf_with_pages(page_sizes):
+    """A PDF whose pages have content streams of about the given sizes, in bytes"""
+    from pypdf import PdfWriter
+    from pypdf.generic import DecodedStreamObject, NameObject
+
+    rng = random.Random(1)
+    writer = PdfWriter()
+    for size in page_sizes:
+        page = writer.add_blank_page(612, 792)
+        content = DecodedStreamObject()
+        content.set_data(b''.join(b'%' + rng.randbytes(40).hex().encode() + b'\n' for _ in range(size // 82)))
+        page[NameObject('/Contents')] = writer._add_object(content)
+    document = io.BytesIO()
+    writer.write(document)
+    return document.getvalue()
+
+
+def test_pdf_parts_stay_under_the_inline_limit(fake, monkeypatch):
+    """Parts are closed before they pass the size limit, not only after a page count"""
+    from pypdf import PdfReader
+
+    monkeypatch.setattr(fake.bot, 'SIZE_LIMIT', 100 * 1024)
+    page_sizes = [random.Random(index).choice([2, 5, 30, 60]) * 1024 for index in range(80)]
+    document = pdf_with_pages(page_sizes)
+    assert len(document) > 4 * fake.bot.SIZE_LIMIT
+
+    part_count, parts = fake.bot.document_chunks(document, {'type': 'PDF'})
+    parts = list(parts)
+    assert len(parts) == part_count
+    assert all(len(part) <= fake.bot.SIZE_LIMIT for part in parts)
+    assert sum(len(PdfReader(io.BytesIO(part)).pages) for part in parts) == len(page_sizes)
+
+
+def test_large_documents_are_refused_without_enough_time(fake, monkeypatch):
+    """A sync webhook has the function timeout to answer, too little for a document in parts"""
+    monkeypatch.setattr(fake.bot, 'SIZE_LIMIT', 64 * 1024)
+    fake.telegram.files['large'] = b'A line of a large document\n' * 5000
+
+    async def run():
+        async with fake.serve() as client:
+            return await fake.send(client, document_update(1, 101, 'large', len(fake.telegram.files['large'])))
+
+    assert asyncio.run(run()).status_code == 200
+    [(chat_id, text)] = fake.telegram.messages.values()
+    assert chat_id == 101 and text.startswith('Documents over 0.1MB take longer to analyze')
+    assert not fake.bedrock.stats.counts
+
+
+class ListQueue:
+    """Keeps the updates put on it"""
+
+    def __init__(self):
+        self.bodies = []
+
+    async def put(self, body):
+        self.bodies.append(body)
+
+
+def test_large_documents_are_handed_off_to_the_document_queue(fake, monkeypatch):
+    """The sync webhook passes a large document on, and the document function, with a longer timeout, analyzes it"""
+    import json
+    import time
+
+    monkeypatch.setattr(fake.bot, 'SIZE_LIMIT', 64 * 1024)
+    monkeypatch.setattr(fake.bot, 'DOCUMENT_CHUNK_SIZE', 16 * 1024)
+    document_queue = ListQueue()
+    monkeypatch.setattr(fake.bot, 'document_queue', document_queue)
+    fake.telegram.files['large'] = b'A line of a large document\n' * 5000
+    update = document_update(1, 101, 'large', len(fake.telegram.files['large']))
+
+    async def run():
+        async with fake.serve() as client:
+            webhook = await fake.send(client, update)
+            handed_off = list(document_queue.bodies)
+            # As delivered by SQS to the document function, with 15 minutes to go
+            context = json.dumps({'deadline': time.time() * 1000 + 900000})
+            records = [{'messageId': 'document', 'body': body} for body in handed_off]
+            events = await client.post('/events', json={'Records': records}, headers={'x-amzn-lambda-context': context})
+            return webhook, handed_off, events
+
+    webhook, handed_off, events = asyncio.run(run())
+    assert webhook.status_code == 200
+    assert [json.loads(body) for body in handed_off] == [update]
+    assert events.json() == {'batchItemFailures': []}
+    # Analyzed in parts, and only once the document function got it
+    assert fake.bedrock.stats.counts['Converse'] > 1
+    assert not [text for chat_id, text in fake.telegram.messages.values() if text.startswith('Documents over')]
+
+
+def test_text_parts_end_on_a_character_boundary(fake, monkeypatch):
+    """Text without line breaks isn't split inside a multi-byte UTF-8 character"""
+    monkeypatch.setattr(fake.bot, 'DOCUMENT_CHUNK_SIZE', 1000)
+    rng = random.Random(1)
+    text = ''.join(rng.choice('aé€😀') for _ in range(3000)).encode()
+
+    part_count, parts = fake.bot.document_chunks(text, {'type': 'TXT'})
+    parts = list(parts)
+    assert len(parts) == part_count > 1
+    assert all(len(part) <= 1000 for part in parts)
+    assert ''.join(part.decode() for part in parts) == text.decode()
@@ -0,0 +1,115 @@
+import asyncio
+import time
+
+import pytest
+from fakes import FakeBedrock, client_error
+
+
+def test_hedged_call_keeps_its_slot_until_it_returns(fake, monkeypatch):
+    """The losing call of a hedge keeps running on its thread, so it still counts against BEDROCK_MAX_IN_FLIGHT"""
+    fake.bedrock.latency = 0.3
+    monkeypatch.setattr(fake.bot, 'MODEL_HEDGE_DELAY', 0.1)
+    router = fake.bot.ModelRouter(['first', 'second'])
+    slots = fake.bot.BEDROCK_MAX_IN_FLIGHT
+
+    async def run():
+        response = await router.converse(hedge=True, messages=[{'role': 'user', 'content': [{'text': 'hi'}]}])
+        # The second call was cancelled, but runs until about 0.4s
+        await asyncio.sleep(0.05)
+        held = fake.bot.model_slots._value
+        await asyncio.sleep(0.3)
+        return response, held, fake.bot.model_slots._value
+
+    response, held, released = asyncio.run(run())
+    assert response['stopReason'] == 'end_turn'
+    assert fake.bedrock.stats.counts['Converse'] == 2
+    assert held == slots - 1 and released == slots
+
+
+class InvalidRequestBedrock(FakeBedrock):
+    def converse(self, **request):
+        self.stats.record('Converse', 0, error=True)
+        raise client_error('ValidationException', 'Converse')
+
+
+def test_invalid_requests_are_not_hedged(fake, monkeypatch):
+    bedrock = InvalidRequestBedrock()
+    monkeypatch.setattr(fake.bot, 'bedrock', bedrock)
+    router = fake.bot.ModelRouter(['first', 'second'])
+
+    with pytest.raises(fake.bot.ClientError):
+        asyncio.run(router.converse(hedge=True, messages=[{'role': 'user', 'content': [{'text': 'hi'}]}]))
+    assert bedrock.stats.counts['Converse'] == 1
+
+
+class PerModelBedrock(FakeBedrock):
+    """Answers each model with its own latency"""
+
+    def __init__(self, latencies):
+        super().__init__(token_latency=0)
+        self.latencies = latencies
+        self.models = []
+
+    def converse(self, modelId, **request):
+        self.models.append(modelId)
+        self.latency = self.latencies[modelId]
+        return super().converse(modelId=modelId, **request)
+
+
+def converse_times(router, count):
+    async def run():
+        for _ in range(count):
+            await router.converse(messages=[{'role': 'user', 'content': [{'text': 'hi'}]}])
+    asyncio.run(run())
+
+
+def test_faster_second_model_gets_chosen(fake, monkeypatch):
+    """The other models are probed for their latency, not only tried once the first is throttled"""
+    bedrock = PerModelBedrock({'first': 0.05, 'second': 0.01})
+    monkeypatch.setattr(fake.bot, 'bedrock', bedrock)
+    router = fake.bot.ModelRouter(['first', 'second'])
+
+    converse_times(router, 5)
+    assert bedrock.models == ['first', 'second', 'second', 'second', 'second']
+    assert router.active == 'second'
+
+
+def test_stale_latencies_are_measured_again(fake, monkeypatch):
+    """Once its samples expire, a model that got slow is probed again and passed over"""
+    bedrock = PerModelBedrock({'first': 0.01, 'second': 0.02})
+    monkeypatch.setattr(fake.bot, 'bedrock', bedrock)
+    monkeypatch.setattr(fake.bot, 'MODEL_LATENCY_MAX_AGE', 0.2)
+    router = fake.bot.ModelRouter(['first', 'second'])
+
+    converse_times(router, 3)
+    assert bedrock.models == ['first', 'second', 'first']
+    # The samples of the first model keep it first until they expire
+    bedrock.latencies['first'] = 0.05
+    converse_times(router, 1)
+    time.sleep(0.25)
+    converse_times(router, 3)
+    assert bedrock.models[3:] == ['first', 'first', 'second', 'second']
+
+
+def test_throttled_hedge_moves_on_to_the_next_model(fake, monkeypatch):
+    bedrock = PerModelBedrock({'first': 0.3, 'second': 0, 'third': 0})
+    monkeypatch.setattr(fake.bot, 'bedrock', bedrock)
+    monkeypatch.setattr(fake.bot, 'MODEL_HEDGE_DELAY', 0.05)
+    router = fake.bot.ModelRouter(['first', 'second', 'third'])
+    router.probed_at = {model: time.monotonic() for model in router.model_ids}
+    converse = bedrock.converse
+
+    def throttle_second(modelId, **request):
+        if modelId == 'second':
+            bedrock.models.append(modelId)
+            raise client_error('ThrottlingException', 'Converse')
+        return converse(modelId=modelId, **request)
+
+    monkeypatch.setattr(bedrock, 'converse', throttle_second)
+
+    async def run():
+        return await router.converse(hedge=True, messages=[{'role': 'user', 'content': [{'text': 'hi'}]}])
+
+    assert asyncio.run(run())['stopReason'] == 'end_turn'
+    assert bedrock.models[:3] == ['first', 'second', 'third']
+    assert router.active == 'third'
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import time
+
+from fakes import FakeTelegramRequest, text_update
+
+
+class RateLimitedTelegram(FakeTelegramRequest):
+    """Answers the first few message edits with 429 Too Many Requests"""
+
+    def __init__(self, failed_edits, retry_after=0):
+        super().__init__(latency=0)
+        self.failed_edits = failed_edits
+        self.retry_after = retry_after
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        if url.endswith('/editMessageText') and self.failed_edits:
+            self.failed_edits -= 1
+            self.stats.record('editMessageText', 0, error=True)
+            return 429, json.dumps({
+                'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}
+            }).encode()
+        return await super().do_request(url, method, request_data, **kwargs)
+
+
+def stream_with(fake, monkeypatch, telegram, edit_interval=0):
+    """Stream replies through the given Telegram fake"""
+    monkeypatch.setattr(fake, 'telegram', telegram)
+    monkeypatch.setattr(fake.bot, 'build_application', lambda concurrent_updates=False: (
+        fake.bot.ApplicationBuilder().token(fake.bot.TelegramBotToken).request(telegram).get_updates_request(telegram).build()
+    ))
+    monkeypatch.setattr(fake.bot, 'STREAM_RESPONSES', True)
+    monkeypatch.setattr(fake.bot, 'STREAM_EDIT_INTERVAL', edit_interval)
+    fake.bedrock.token_latency = 0.005
+
+
+def test_failed_progress_edits_keep_the_reply(fake, monkeypatch):
+    telegram = RateLimitedTelegram(failed_edits=3)
+    stream_with(fake, monkeypatch, telegram)
+
+    async def run():
+        async with fake.serve() as client:
+            return await fake.send(client, text_update(1, 101, 'hello'))
+
+    assert asyncio.run(run()).status_code == 200
+    assert telegram.stats.errors['editMessageText'] == 3
+    # The placeholder ends up holding the whole reply, not the error message
+    [(chat_id, text)] = telegram.messages.values()
+    assert chat_id == 101
+    assert len(text) >= fake.bedrock.reply_chars and not text.startswith('Sorry')
+
+
+def test_rate_limited_final_edit_is_retried(fake, monkeypatch):
+    """Without progress edits, the 429 of the final edit is waited out and the edit made again"""
+    telegram = RateLimitedTelegram(failed_edits=1, retry_after=1)
+    stream_with(fake, monkeypatch, telegram, edit_interval=3600)
+
+    async def run():
+        async with fake.serve() as client:
+            started = time.perf_counter()
+            response = await fake.send(client, text_update(1, 101, 'hello'))
+            return response, time.perf_counter() - started
+
+    response, elapsed = asyncio.run(run())
+    assert response.status_code == 200 and elapsed >= 1
+    assert telegram.stats.counts['editMessageText'] == 2
+    [(chat_id, text)] = telegram.messages.values()
+    assert len(text) >= fake.bedrock.reply_chars
+
+
+def test_reply_is_sent_as_a_new_message_when_edits_keep_failing(fake, monkeypatch):
+    """A generated reply isn't lost, or generated again, because its placeholder can't be edited"""
+    telegram = RateLimitedTelegram(failed_edits=1000)
+    stream_with(fake, monkeypatch, telegram)
+
+    async def run():
+        async with fake.serve() as client:
+            return await fake.send(client, text_update(1, 101, 'hello'))
+
+    assert asyncio.run(run()).status_code == 200
+    assert fake.bedrock.stats.counts['ConverseStream'] == 1
+    placeholder, reply = telegram.messages.values()
+    assert placeholder == (101, '...')
+    assert reply[0] == 101 and len(reply[1]) >= fake.bedrock.reply_chars
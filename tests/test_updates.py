@@ -0,0 +1,78 @@
+import asyncio
+import json
+
+from fakes import text_update
+
+
+def test_failed_update_gets_a_server_error(fake):
+    """Telegram delivers the update again after an error response"""
+    fake.bedrock.throttle_rate = 1.0
+
+    async def run():
+        async with fake.serve() as client:
+            return await fake.send(client, text_update(1, 101, 'hello'))
+
+    assert asyncio.run(run()).status_code == 500
+    # The user message is only stored with the reply, so a retry doesn't store it twice
+    assert not [key for key in fake.table.items if key[0] == '101']
+
+
+def test_sqs_batch_reports_the_failed_updates(fake):
+    """Only the failed updates of a batch are delivered again by SQS"""
+    fake.bedrock.throttle_rate = 1.0
+    records = [
+        {'messageId': 'text', 'body': json.dumps(text_update(1, 101, 'hello'))},
+        {'messageId': 'command', 'body': json.dumps(text_update(2, 102, '/start'))}
+    ]
+
+    async def run():
+        async with fake.serve() as client:
+            return await client.post('/events', json={'Records': records})
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert response.json() == {'batchItemFailures': [{'itemIdentifier': 'text'}]}
+
+
+def test_failed_update_is_released_for_redelivery(fake):
+    """A failed update isn't skipped as a duplicate when Telegram delivers it again"""
+    update = text_update(1, 101, 'hello')
+
+    async def run():
+        async with fake.serve() as client:
+            fake.bedrock.throttle_rate = 1.0
+            failed = await fake.send(client, update)
+            marker = fake.table.items.get(('UPDATE#1', 'UPDATE'))
+            fake.bedrock.throttle_rate = 0.0
+            redelivered = await fake.send(client, update)
+            duplicate = await fake.send(client, update)
+            return failed, marker, redelivered, duplicate
+
+    failed, marker, redelivered, duplicate = asyncio.run(run())
+    assert failed.status_code == 500 and marker is None
+    assert redelivered.status_code == 200 and duplicate.status_code == 200
+    # Answered once, by the redelivery
+    assert fake.bedrock.stats.counts['Converse'] - fake.bedrock.stats.errors['Converse'] == 1
+    assert ('UPDATE#1', 'UPDATE') in fake.table.items
+    assert [text for chat_id, text in fake.telegram.messages.values() if chat_id == 101]
+
+
+def test_update_is_processed_when_the_marker_write_fails(fake, monkeypatch):
+    """A transport error on the marker write doesn't leave the update claimed but unanswered"""
+    from botocore.exceptions import EndpointConnectionError
+    put_item = fake.table.put_item
+
+    def unreachable(Item, **kwargs):
+        if Item['chat_id'].startswith('UPDATE#'):
+            raise EndpointConnectionError(endpoint_url='https://dynamodb.us-east-1.amazonaws.com')
+        return put_item(Item, **kwargs)
+
+    monkeypatch.setattr(fake.table, 'put_item', unreachable)
+
+    async def run():
+        async with fake.serve() as client:
+            return await fake.send(client, text_update(1, 101, 'hello'))
+
+    assert asyncio.run(run()).status_code == 200
+    assert fake.bedrock.stats.counts['Converse'] == 1
+    assert [text for chat_id, text in fake.telegram.messages.values() if chat_id == 101]
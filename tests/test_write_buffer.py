@@ -0,0 +1,36 @@
+import asyncio
+
+from fakes import text_update
+
+
+def test_setting_change_keeps_the_settings_changed_elsewhere(fake):
+    """A toggle only writes its own attribute, not the whole settings item cached in this process"""
+
+    async def run():
+        async with fake.serve() as client:
+            # Cache the settings of the chat in this process
+            await fake.send(client, text_update(1, 101, 'hello'))
+            # Another process enables thinking
+            fake.table.items[('101', 'SETTINGS')] = {'chat_id': '101', 'timestamp': 'SETTINGS', 'thinking_enabled': True}
+            await fake.send(client, text_update(2, 101, '/debug'))
+
+    asyncio.run(run())
+    settings = fake.table.items[('101', 'SETTINGS')]
+    assert settings['thinking_enabled'] is True and settings['debug_enabled'] is True
+
+
+def test_flush_waits_for_the_writes_in_flight(fake):
+    """A flush with nothing left to write still waits for an earlier flush, like a timed one"""
+    fake.table.latency = 0.2
+    buffer = fake.bot.WriteBuffer(max_items=25, max_delay=1)
+
+    async def run():
+        buffer.put({'chat_id': '101', 'timestamp': 'M#1', 'content': 'hello'})
+        earlier = asyncio.create_task(buffer.flush())
+        await asyncio.sleep(0.05)
+        await buffer.flush()
+        written = ('101', 'M#1') in fake.table.items
+        await earlier
+        return written
+
+    assert asyncio.run(run())